@@ -0,0 +1,80 @@
+"""
+An in-process index of which works have been archived, so checking whether works exist doesn't query the database.
+It's loaded when the notification listener connects, and kept up to date by the work_archived notification sent for
+every new version.
+"""
+import asyncio
+from typing import Iterable, List, Set
+import psycopg
+import db
+import notifications
+
+
+class WorkIdBitmap:
+    """A set of work ids stored as one bit per id. AO3 ids are dense, so this is a few MB for every work there is."""
+    def __init__(self, work_ids: Iterable[int] = ()):
+        self.bits = bytearray()
+        for work_id in work_ids:
+            self.add(work_id)
+
+    def add(self, work_id: int) -> None:
+        if work_id < 0:  # Not a real work, and there's no bit for it
+            return
+        byte = work_id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits) // 4)))
+        self.bits[byte] |= 1 << (work_id & 7)
+
+    def __contains__(self, work_id: int) -> bool:
+        byte = work_id >> 3
+        return 0 <= work_id and byte < len(self.bits) and bool(self.bits[byte] & (1 << (work_id & 7)))
+
+
+class ArchivedWorks:
+    def __init__(self):
+        self.bitmap = WorkIdBitmap()
+        # Until the bitmap is loaded, and while it's reloaded after missing notifications, the database is asked instead
+        self.loaded = False
+        self._notified_while_loading: Set[int] = set()
+        self._load_task: asyncio.Task | None = None
+
+    def on_notify(self, payload: str | None) -> None:
+        if payload is None:
+            # Notifications may have been missed, so the bitmap is rebuilt
+            self.loaded = False
+            if self._load_task is not None:
+                self._load_task.cancel()
+            self._notified_while_loading = set()
+            self._load_task = asyncio.create_task(self._load())
+            return
+        work_id = int(payload)
+        self.bitmap.add(work_id)
+        if not self.loaded:
+            self._notified_while_loading.add(work_id)
+
+    async def _load(self) -> None:
+        try:
+            async with db.ConnManager():
+                work_ids = await db.get_archived_work_ids()
+        except psycopg.Error as e:
+            print(f"Loading archived works failed, work existence checks will query the database: {e}")
+            return
+        bitmap = await asyncio.to_thread(WorkIdBitmap, work_ids)
+        # Works archived after the query started are only known from their notification
+        for work_id in self._notified_while_loading:
+            bitmap.add(work_id)
+        self.bitmap = bitmap
+        self._notified_while_loading = set()
+        self.loaded = True
+
+    async def existing(self, work_ids: List[int]) -> Set[int]:
+        """Returns which of the given works have been archived"""
+        # The bitmap can't hold negative ids, so requests with any are answered by the database
+        if self.loaded and all(work_id >= 0 for work_id in work_ids):
+            return {work_id for work_id in work_ids if work_id in self.bitmap}
+        async with db.ConnManager():
+            return await db.existing_works(work_ids)
+
+
+archived_works = ArchivedWorks()
+notifications.listener.on("work_archived", archived_works.on_notify)
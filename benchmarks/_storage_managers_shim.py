@@ -0,0 +1,11 @@
+"""
+Lets benchmarks import modules from storage_managers without running the package __init__, which connects to the
+database. Import this before anything from storage_managers.
+"""
+import os
+import sys
+import types
+
+_package = types.ModuleType("storage_managers")
+_package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage_managers")]
+sys.modules.setdefault("storage_managers", _package)
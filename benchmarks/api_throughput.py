@@ -0,0 +1,179 @@
+"""
+Drives the API end to end and reports throughput, latency percentiles and database queries per request, as JSON so runs
+can be compared. The app runs in process through the ASGI transport of httpx (listed in requirements.txt), against the
+Postgres configured by the usual POSTGRESQL_* variables. It writes to that database, so point it at a scratch one.
+Storage defaults to the in memory backend, STORAGE_BACKEND=filesystem works too. Set VERSION_CACHE_BYTES=0 to measure
+version reads without the cache.
+
+    python benchmarks/api_throughput.py --works 200 --versions 3 --concurrency 16 --output results.json
+
+Each version round reports every work, leases the jobs and submits them. Afterward every stored version is read back
+and the works are downloaded in bulk zips.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+import psycopg  # noqa: E402
+import db  # noqa: E402
+from main import app  # noqa: E402
+
+
+class CountingCursor(psycopg.AsyncCursor):
+    """Counts every statement sent to Postgres"""
+    queries = 0
+
+    async def execute(self, *args, **kwargs):
+        CountingCursor.queries += 1
+        return await super().execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        CountingCursor.queries += 1
+        return await super().executemany(*args, **kwargs)
+
+
+class Scenario:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.seconds = 0.0
+        self.queries = 0
+
+    async def run(self, requests, concurrency: int) -> list:
+        """Runs request coroutines with at most concurrency in flight, returning their responses"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def timed(request):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await request
+                except Exception as e:
+                    print(f"{self.name} request failed: {e!r}", file=sys.stderr)
+                    response = None
+                self.latencies.append(time.perf_counter() - start)
+                if response is None or response.status_code >= 400:
+                    self.errors += 1
+                return response
+
+        queries_before = CountingCursor.queries
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[timed(request) for request in requests])
+        self.seconds += time.perf_counter() - start
+        self.queries += CountingCursor.queries - queries_before
+        return responses
+
+    def result(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction: float) -> float:
+            return latencies[round(fraction * (len(latencies) - 1))] * 1000 if latencies else 0.0
+
+        return {"requests": len(latencies), "errors": self.errors, "seconds": self.seconds,
+                "requests_per_second": len(latencies) / self.seconds if self.seconds else 0.0,
+                "latency_ms": {"p50": percentile(.5), "p90": percentile(.9), "p99": percentile(.99),
+                               "max": percentile(1)},
+                "db_queries_per_request": self.queries / len(latencies) if latencies else 0.0}
+
+
+def make_work(rng: random.Random, work_id: int, paragraphs: list[str], version: int) -> bytes:
+    """Renders a version of a work, with a few paragraphs edited each version"""
+    for _ in range(max(1, len(paragraphs) // 50)):
+        paragraphs[rng.randrange(len(paragraphs))] = f"<p>Edited in version {version}. {rng.random()}</p>\n"
+    return f"<html><body><h1>Work {work_id}</h1>\n{''.join(paragraphs)}</body></html>".encode("utf-8")
+
+
+async def benchmark(args) -> dict:
+    rng = random.Random(args.seed)
+    work_ids = [rng.randrange(10 ** 8, 2 * 10 ** 8) for _ in range(args.works)]
+    sentence = "The quick brown fox jumps over the lazy dog, and then does it again. "
+    paragraph_count = max(1, args.work_size // (len(sentence) * 6 + 8))
+    work_paragraphs = {work_id: [f"<p>{sentence * 6}{i}</p>\n" for i in range(paragraph_count)]
+                       for work_id in work_ids}
+    headers = {"token": os.environ.get("ADMIN_TOKEN", "")}
+    scenarios = {name: Scenario(name) for name in
+                 ("report_work", "request_job", "submit_job", "work_version", "bulk_zip")}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark",
+                                 timeout=None) as client:
+        for version in range(args.versions):
+            await scenarios["report_work"].run([
+                client.post("/report_work", json={"work_id": work_id, "updated_time": version + 1,
+                                                  "reporter": "benchmark"})
+                for work_id in work_ids], args.concurrency)
+
+            job_responses = await scenarios["request_job"].run([
+                client.post("/request_job", json={"client_name": "benchmark"}, headers=headers)
+                for _ in work_ids], args.concurrency)
+            jobs = [response.json() for response in job_responses
+                    if response is not None and response.status_code == 200
+                    and response.json()["status"] == "job assigned"]
+
+            await scenarios["submit_job"].run([
+                client.post("/submit_job", headers=headers,
+                            data={"dispatch_id": job["dispatch_id"], "report_code": job["report_code"]},
+                            files={"work": ("work.html", make_work(rng, job["work_id"],
+                                                                   work_paragraphs[job["work_id"]], version),
+                                            "text/html")})
+                for job in jobs if job["work_id"] in work_paragraphs], args.concurrency)
+
+        versions = []
+        async with db.ConnManager():
+            for work_id in work_ids:
+                versions.extend((work_id, work.storage_id) for work in await db.get_work_versions(work_id))
+        rng.shuffle(versions)
+        await scenarios["work_version"].run([
+            client.get(f"/works/{work_id}", params={"version": storage_id})
+            for work_id, storage_id in versions], args.concurrency)
+
+        async def bulk_download(batch: list[int]):
+            response = await client.post("/works/dl/bulk_prepare",
+                                         json={"works": [{"work_id": work_id, "title": f"work {work_id}"}
+                                                         for work_id in batch]})
+            if response.status_code >= 400:
+                return response
+            return await client.get(f"/works/dl/bulk_dl/{response.json()['dl_id']}")
+
+        batches = [work_ids[i:i + args.bulk_size] for i in range(0, len(work_ids), args.bulk_size)]
+        await scenarios["bulk_zip"].run([bulk_download(batch) for batch in batches], args.concurrency)
+
+    return {"config": vars(args), "storage_backend": os.environ["STORAGE_BACKEND"],
+            "scenarios": {name: scenario.result() for name, scenario in scenarios.items()}}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--works", type=int, default=200)
+    parser.add_argument("--versions", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--work-size", type=int, default=50 * 1024, help="approximate size of each work in bytes")
+    parser.add_argument("--bulk-size", type=int, default=50, help="works per bulk zip download")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    args = parser.parse_args()
+
+    db.pool.kwargs = {**(db.pool.kwargs or {}), "cursor_factory": CountingCursor}
+    await db.open_pool()
+    try:
+        results = await benchmark(args)
+    finally:
+        await db.close_pool()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+"""
+Compares compression codecs on ratio, compression speed and decompression speed. Decompression runs on every read, so
+it matters most.
+
+    python benchmarks/compression.py                  # synthetic html works
+    python benchmarks/compression.py works_dir/       # every file in a directory, e.g. downloaded works
+
+Half the works are used to train a zstd dictionary, and every codec is measured on the other half, both as whole works
+and as content-defined chunks (which is what chunked storage compresses).
+"""
+import os
+import sys
+import time
+import zlib
+import zstandard
+
+import _storage_managers_shim  # noqa: F401
+from storage_managers.chunking import split_chunks
+from storage_managers.compression import train_dictionary
+from delta_codecs import synthetic_versions
+
+
+def load_works() -> list[bytes]:
+    if len(sys.argv) == 2:
+        works = []
+        for file_name in sorted(os.listdir(sys.argv[1])):
+            with open(os.path.join(sys.argv[1], file_name), "rb") as file:
+                works.append(file.read())
+        return works
+    return [synthetic_versions(size, seed)[1] for seed, size in enumerate([50 * 1024, 200 * 1024, 600 * 1024] * 4)]
+
+
+def measure(compress, decompress, blobs: list[bytes]) -> tuple[float, float, float]:
+    """Returns the compression ratio, and compression and decompression speed in MB/s"""
+    start = time.perf_counter()
+    compressed = [compress(blob) for blob in blobs]
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for blob in compressed:
+        decompress(blob)
+    decompress_time = time.perf_counter() - start
+    size = sum(len(blob) for blob in blobs)
+    return (size / sum(len(blob) for blob in compressed), size / compress_time / 1e6,
+            size / decompress_time / 1e6)
+
+
+def main():
+    works = load_works()
+    training, testing = works[::2], works[1::2]
+    training_chunks = [chunk for work in training for chunk in split_chunks(work)]
+    dictionary = train_dictionary(training_chunks, 112 * 1024, level=9)
+    testing_chunks = [chunk for work in testing for chunk in split_chunks(work)]
+
+    codecs = {
+        "zlib 6": (zlib.compress, zlib.decompress),
+        "zlib 9": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    }
+    for level in (3, 9, 19):
+        codecs[f"zstd {level}"] = (zstandard.ZstdCompressor(level=level).compress,
+                                   zstandard.ZstdDecompressor().decompress)
+    codecs["zstd 9 + dict"] = (zstandard.ZstdCompressor(level=9, dict_data=dictionary).compress,
+                               zstandard.ZstdDecompressor(dict_data=dictionary).decompress)
+
+    print(f"{len(testing)} works ({sum(map(len, testing))} bytes), {len(testing_chunks)} chunks, "
+          f"dictionary trained on {len(training)} works")
+    print(f"{'codec':<15}{'blobs':<8}{'ratio':>8}{'comp MB/s':>11}{'decomp MB/s':>13}")
+    for name, (compress, decompress) in codecs.items():
+        for blob_name, blobs in (("works", testing), ("chunks", testing_chunks)):
+            ratio, compress_speed, decompress_speed = measure(compress, decompress, blobs)
+            print(f"{name:<15}{blob_name:<8}{ratio:>8.2f}{compress_speed:>11.1f}{decompress_speed:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Compares the delta codecs on diff time, patch time, peak memory and delta size.
+
+    python benchmarks/delta_codecs.py                     # synthetic html works of a few sizes
+    python benchmarks/delta_codecs.py old.html new.html   # a real pair of versions
+
+Every measurement runs in a fresh process so peak RSS growth reflects only that one operation. RSS is read
+from /proc, so this runs on Linux only.
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import _storage_managers_shim  # noqa: F401
+from storage_managers.delta_codecs import delta_codecs
+
+
+def synthetic_versions(size: int, seed: int = 0) -> tuple[bytes, bytes]:
+    """Makes an html work around size bytes, and an older version of it with a few paragraphs edited"""
+    rng = random.Random(seed)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(5000)]
+    paragraphs = []
+    total = 0
+    while total < size:
+        paragraph = b"<p>" + b" ".join(rng.choice(words) for _ in range(rng.randint(20, 120))) + b"</p>\n"
+        paragraphs.append(paragraph)
+        total += len(paragraph)
+    old_paragraphs = list(paragraphs)
+    for _ in range(max(1, len(paragraphs) // 200)):
+        index = rng.randrange(len(old_paragraphs))
+        old_paragraphs[index] = b"<p>" + b" ".join(rng.choice(words) for _ in range(40)) + b"</p>\n"
+    return b"".join(old_paragraphs), b"".join(paragraphs)
+
+
+# Run in a bare interpreter, rather than one that re-imports this script, so little else happens in the process. The
+# kernel's peak RSS is reset just before the operation, so the growth is the operation's alone.
+_MEASURE_SCRIPT = """
+import json, os, sys, time
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+import _storage_managers_shim
+from storage_managers.delta_codecs import delta_codecs
+
+def memory_status(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+
+codec_name, operation, source_path, other_path = sys.argv[2:]
+with open(source_path, "rb") as source_file, open(other_path, "rb") as other_file:
+    source, other = source_file.read(), other_file.read()
+codec = delta_codecs[codec_name]
+with open("/proc/self/clear_refs", "w") as clear_refs:
+    clear_refs.write("5")
+baseline = memory_status("VmRSS")
+start = time.perf_counter()
+result = codec.diff(source, other) if operation == "diff" else codec.patch(source, other)
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, max(0, memory_status("VmHWM") - baseline), len(result)]))
+"""
+
+
+def measure(codec_name: str, operation: str, source: bytes, other: bytes) -> tuple[float, int, int]:
+    """Runs one operation in a new process, returning seconds taken, peak RSS growth and output size"""
+    with tempfile.TemporaryDirectory() as directory:
+        paths = [os.path.join(directory, "source"), os.path.join(directory, "other")]
+        for path, data in zip(paths, (source, other)):
+            with open(path, "wb") as file:
+                file.write(data)
+        output = subprocess.run([sys.executable, "-c", _MEASURE_SCRIPT, os.path.abspath(__file__), codec_name,
+                                 operation, *paths], check=True, capture_output=True, text=True).stdout
+    elapsed, rss_growth, size = json.loads(output)
+    return elapsed, rss_growth, size
+
+
+def main():
+    if len(sys.argv) == 3:
+        with open(sys.argv[1], "rb") as old_file, open(sys.argv[2], "rb") as new_file:
+            samples = [(os.path.basename(sys.argv[2]), old_file.read(), new_file.read())]
+    else:
+        samples = [(f"synthetic {size // 1024} KiB", *synthetic_versions(size))
+                   for size in (100 * 1024, 1024 ** 2, 5 * 1024 ** 2)]
+
+    print(f"{'sample':<22}{'codec':<11}{'delta':>11}{'diff s':>9}{'diff RSS':>11}{'patch s':>9}{'patch RSS':>11}")
+    for sample_name, old, new in samples:
+        for codec_name in delta_codecs:
+            # Older versions are stored as a diff against the version after them
+            diff_time, diff_rss, delta_size = measure(codec_name, "diff", new, old)
+            delta = delta_codecs[codec_name].diff(new, old)
+            patch_time, patch_rss, _ = measure(codec_name, "patch", new, delta)
+            print(f"{sample_name:<22}{codec_name:<11}{delta_size:>11}{diff_time:>9.3f}"
+                  f"{diff_rss / 1024 ** 2:>10.1f}M{patch_time:>9.3f}{patch_rss / 1024 ** 2:>10.1f}M")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Compares the single pass source rewriter against the previous per-object approach, on works with many images.
+
+    python benchmarks/html_rewrite.py
+"""
+import html
+import random
+import time
+from bs4.dammit import UnicodeDammit
+
+import _storage_managers_shim  # noqa: F401
+from storage_managers.html_rewriter import SourceRewriter
+
+
+def make_work(images: int, size: int, seed: int = 0) -> tuple[bytes, list[str]]:
+    """Makes an html work of about size bytes with the given number of images, half of them with escaped urls"""
+    rng = random.Random(seed)
+    urls = [f"https://img{rng.randint(0, 9)}.example.com/{rng.randint(0, 10 ** 9)}/image_{i}.png?w=800&h={i}"
+            for i in range(images)]
+    paragraph = "<p>" + " ".join(["Lorem ipsum dolor sit amet, the quick brown fox jumps."] * 8) + "</p>\n"
+    paragraphs_per_image = max(1, size // len(paragraph) // images)
+    parts = ["<html><head><meta charset=\"utf-8\"></head><body>\n"]
+    for i, url in enumerate(urls):
+        parts.append(paragraph * paragraphs_per_image)
+        parts.append(f'<img src="{html.escape(url) if i % 2 else url}">\n')
+    parts.append("</body></html>")
+    return "".join(parts).encode("utf-8"), urls
+
+
+def legacy_rewrite(work: bytes, urls: list[str]) -> bytes:
+    """The approach used before the single pass rewriter"""
+    work_text = UnicodeDammit(work, is_html=True).unicode_markup
+    for url in urls:
+        if url not in work_text and html.escape(url) not in work_text:
+            raise ValueError(url)
+    for object_id, url in enumerate(urls):
+        if url in work_text:
+            work_text = work_text.replace(url, f"/objects/{object_id}", 1)
+        else:
+            work_text = work_text.replace(html.escape(url), f"/objects/{object_id}", 1)
+    return work_text.encode("utf-8")
+
+
+def single_pass_rewrite(work: bytes, urls: list[str]) -> bytes:
+    return SourceRewriter(work, urls).rewrite([f"/objects/{object_id}" for object_id in range(len(urls))])
+
+
+def best_time(func, *args, repeats: int = 3) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    print(f"{'images':>7}{'size':>10}{'legacy s':>11}{'single pass s':>15}{'speedup':>9}")
+    for images, size in ((10, 200 * 1024), (100, 1024 ** 2), (300, 2 * 1024 ** 2), (1000, 4 * 1024 ** 2)):
+        work, urls = make_work(images, size)
+        assert legacy_rewrite(work, urls) == single_pass_rewrite(work, urls)
+        legacy = best_time(legacy_rewrite, work, urls)
+        single_pass = best_time(single_pass_rewrite, work, urls)
+        print(f"{images:>7}{len(work):>10}{legacy:>11.3f}{single_pass:>15.3f}{legacy / single_pass:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
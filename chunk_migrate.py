@@ -0,0 +1,97 @@
+"""
+Moves stored works over to chunked storage, and reports how much space chunking saves.
+
+    python chunk_migrate.py report            Estimates the savings on the current archive without changing anything
+    python chunk_migrate.py migrate [limit]   Converts up to limit (default all) unchunked versions, newest first
+"""
+import asyncio
+import hashlib
+import sys
+import db
+from file_storage import storage
+from storage_managers.chunking import split_chunks
+from storage_managers.compression import compress
+
+page_size = 100
+
+
+async def unchunked_entries(limit: int | None = None):
+    before_storage_id = None
+    count = 0
+    while True:
+        async with db.ConnManager():
+            page = await db.get_storage_page(False, before_storage_id, page_size)
+        if not page:
+            return
+        for storage_entry in page:
+            if limit is not None and count >= limit:
+                return
+            yield storage_entry
+            count += 1
+        before_storage_id = page[-1].storage_id
+
+
+async def report():
+    versions = 0
+    logical_bytes = 0
+    stored_bytes = 0
+    chunk_sizes = {}  # compressed size of each unique chunk
+    async for storage_entry in unchunked_entries():
+        async with db.ConnManager():
+            work, _ = await storage.get_work(storage_entry.storage_id)
+        versions += 1
+        logical_bytes += len(work)
+        stored_bytes += await storage.get_file_size_async(storage_entry.location)
+        for chunk in await asyncio.to_thread(split_chunks, work):
+            chunk_sha1 = hashlib.sha1(chunk).hexdigest()
+            if chunk_sha1 not in chunk_sizes:
+                chunk_sizes[chunk_sha1] = len(compress(chunk))
+        if versions % 100 == 0:
+            print(f"scanned {versions} versions...")
+
+    chunked_bytes = sum(chunk_sizes.values())
+    print(f"unchunked versions: {versions}")
+    print(f"uncompressed size of all versions: {logical_bytes} bytes")
+    print(f"currently stored (full copies + diffs): {stored_bytes} bytes")
+    print(f"stored as chunks: {chunked_bytes} bytes in {len(chunk_sizes)} unique chunks")
+    if stored_bytes:
+        print(f"saving: {stored_bytes - chunked_bytes} bytes ({(1 - chunked_bytes / stored_bytes) * 100:.1f}%)")
+
+    async with db.ConnManager():
+        chunk_count, chunk_bytes, referenced_bytes = await db.get_chunk_stats()
+    print(f"already chunked: {referenced_bytes} bytes of versions stored in {chunk_bytes} bytes of {chunk_count} chunks")
+
+
+async def migrate(limit: int | None):
+    migrated = 0
+    async for storage_entry in unchunked_entries(limit):
+        # Each version is converted in its own transaction, so an interrupted migration can just be run again
+        async with db.ConnManager():
+            work, _ = await storage.get_work(storage_entry.storage_id)
+            await storage.store_chunks(storage_entry.storage_id, work)
+            await db.mark_storage_chunked(storage_entry.storage_id)
+        async with db.ConnManager():
+            still_used = await db.location_in_use(storage_entry.location)
+        if not still_used:
+            await storage.delete_file_async(storage_entry.location)
+        migrated += 1
+        if migrated % 100 == 0:
+            print(f"migrated {migrated} versions...")
+    print(f"migrated {migrated} versions")
+
+
+async def main():
+    await db.open_pool()
+    try:
+        if len(sys.argv) >= 2 and sys.argv[1] == "report":
+            await report()
+        elif len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+            await migrate(int(sys.argv[2]) if len(sys.argv) >= 3 else None)
+        else:
+            print(__doc__)
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+"""
+Trains zstd dictionaries and recompresses stored blobs with the current codec.
+
+    python compression_tool.py train [dict_size]   Trains a dictionary (default 112 KiB) on recent html and txt works
+                                                   and saves it to ZSTD_DICT_DIR. New blobs are written with it once
+                                                   ZSTD_DICT_ID is set to its id.
+    python compression_tool.py recompress [limit]  Rewrites up to limit (default all) blobs that aren't compressed with
+                                                   the current codec and dictionary
+
+Recompression only touches blobs that never change after being written, old versions and chunks. A head's blob is
+replaced with a diff when the next version arrives, so heads pick up the new codec then.
+RECOMPRESS_DELAY seconds (default 0) are slept between pages to keep the load down while the server is running.
+"""
+import asyncio
+import os
+import sys
+import db
+from file_storage import storage
+from storage_managers.chunking import split_chunks
+from storage_managers.compression import compress, decompress, needs_recompression, train_dictionary, zstd_dict_dir
+
+page_size = 100
+training_works = int(os.environ.get("ZSTD_TRAINING_WORKS", 2000))
+recompress_delay = float(os.environ.get("RECOMPRESS_DELAY", 0))
+
+
+async def train(dict_size: int):
+    if not zstd_dict_dir:
+        print("ZSTD_DICT_DIR must be set")
+        return
+
+    samples = []
+    sampled_works = 0
+    before_storage_id = None
+    while sampled_works < training_works:
+        async with db.ConnManager():
+            page = await db.get_storage_page(False, before_storage_id, page_size)
+        if not page:
+            break
+        heads = [entry for entry in page if entry.patch_of is None and entry.format in ("html", "txt")]
+        works = await storage.get_files_compressed_async([entry.location for entry in heads])
+        for work in works[:training_works - sampled_works]:
+            # zstd trains better on many small samples than a few large ones
+            samples.extend(await asyncio.to_thread(split_chunks, work))
+        sampled_works += len(works)
+        before_storage_id = page[-1].storage_id
+
+    if not samples:
+        print("no html or txt works to train on")
+        return
+    print(f"training on {len(samples)} samples from {sampled_works} works...")
+    dictionary = await asyncio.to_thread(train_dictionary, samples, dict_size)
+    os.makedirs(zstd_dict_dir, exist_ok=True)
+    path = os.path.join(zstd_dict_dir, f"{dictionary.dict_id()}.zdict")
+    with open(path, "wb") as file:
+        file.write(dictionary.as_bytes())
+    print(f"saved dictionary {dictionary.dict_id()} to {path}, set ZSTD_DICT_ID={dictionary.dict_id()} to use it")
+
+
+async def recompress_blob(location: str) -> tuple[int, int]:
+    """Recompresses one blob if needed, returning its size before and after"""
+    blob = await storage.get_file_async(location)
+    if not needs_recompression(blob):
+        return len(blob), len(blob)
+    recompressed = await asyncio.to_thread(lambda: compress(decompress(blob)))
+    await storage.store_file_async(location, recompressed)
+    return len(blob), len(recompressed)
+
+
+async def immutable_locations():
+    before_storage_id = None
+    while True:
+        async with db.ConnManager():
+            page = await db.get_storage_page(False, before_storage_id, page_size)
+        if not page:
+            break
+        yield [entry.location for entry in page if entry.patch_of is not None]
+        before_storage_id = page[-1].storage_id
+
+    after_sha1 = None
+    while True:
+        async with db.ConnManager():
+            page = await db.get_chunk_page(after_sha1, page_size)
+        if not page:
+            break
+        yield [location for _, location in page]
+        after_sha1 = page[-1][0]
+
+
+async def recompress(limit: int | None):
+    scanned = 0
+    bytes_before = 0
+    bytes_after = 0
+    async for locations in immutable_locations():
+        if limit is not None:
+            locations = locations[:limit - scanned]
+        sizes = await storage._bounded_gather([recompress_blob(location) for location in locations])
+        scanned += len(locations)
+        bytes_before += sum(before for before, _ in sizes)
+        bytes_after += sum(after for _, after in sizes)
+        print(f"scanned {scanned} blobs, {bytes_before} -> {bytes_after} bytes")
+        if limit is not None and scanned >= limit:
+            break
+        await asyncio.sleep(recompress_delay)
+
+
+async def main():
+    await db.open_pool()
+    try:
+        if len(sys.argv) >= 2 and sys.argv[1] == "train":
+            await train(int(sys.argv[2]) if len(sys.argv) >= 3 else 112 * 1024)
+        elif len(sys.argv) >= 2 and sys.argv[1] == "recompress":
+            await recompress(int(sys.argv[2]) if len(sys.argv) >= 3 else None)
+        else:
+            print(__doc__)
+    finally:
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
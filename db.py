@@ -1,17 +1,25 @@
+import asyncio
 import datetime
 import hashlib
-import random
 import re
 import time
+import uuid
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextvars import ContextVar
 from enum import Enum
 from stat import S_IFREG
-from typing import List, Dict
+from typing import List, Dict, BinaryIO, Set
 from stream_zip import stream_zip, ZIP_64
-from typing_extensions import TypedDict
-from pydantic import BaseModel
+from typing_extensions import TypedDict, NotRequired
+from pydantic import BaseModel, ConfigDict, SkipValidation
 import os.path
-import psycopg2
+import psycopg
+from psycopg import AsyncConnection
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 import db_updater
+import metrics
 
 valid_formats = ["pdf", "epub", "azw3", "mobi", "html", "txt"]
 format_mimetypes = {
@@ -23,30 +31,87 @@ format_mimetypes = {
     "txt": "text/plain"
 }
 
-conn = psycopg2.connect(database=os.environ["POSTGRESQL_DATABASE"],
-                        host=os.environ["POSTGRESQL_HOST"],
-                        user=os.environ["POSTGRESQL_USER"],
-                        password=os.environ["POSTGRESQL_PASSWORD"],
-                        port=os.environ["POSTGRESQL_PORT"])
+conninfo = psycopg.conninfo.make_conninfo(dbname=os.environ["POSTGRESQL_DATABASE"],
+                                           host=os.environ["POSTGRESQL_HOST"],
+                                           user=os.environ["POSTGRESQL_USER"],
+                                           password=os.environ["POSTGRESQL_PASSWORD"],
+                                           port=os.environ["POSTGRESQL_PORT"])
+
+# Each gunicorn worker gets its own pool. The pool is opened from the app lifespan, as it needs a running event loop.
+pool = AsyncConnectionPool(conninfo,
+                           min_size=int(os.environ.get("POSTGRESQL_POOL_MIN_SIZE", 2)),
+                           max_size=int(os.environ.get("POSTGRESQL_POOL_MAX_SIZE", 10)),
+                           timeout=float(os.environ.get("POSTGRESQL_POOL_TIMEOUT", 30)),
+                           open=False)
+
+# Arbitrary key for the advisory lock held while migrating
+migration_lock_id = 0x6A03
+
+_request_conn: ContextVar[AsyncConnection | None] = ContextVar("_request_conn", default=None)
+
+
+class NoConnection(Exception):
+    """This is used when a query is attempted outside of a ConnManager block"""
+
+
+def conn() -> AsyncConnection:
+    """Returns the connection checked out by the enclosing ConnManager"""
+    request_conn = _request_conn.get()
+    if request_conn is None:
+        raise NoConnection("Database functions must be called within a ConnManager block")
+    return request_conn
 
 
 class ConnManager:
+    """
+    Checks a connection out of the pool for the duration of the block. Everything run inside the block shares one
+    transaction, which is committed on a clean exit and rolled back on an exception. Nested blocks reuse the outer
+    connection and transaction.
+    """
     def __init__(self):
-        pass
+        self._pool_conn = None
+        self._token = None
 
-    def __enter__(self):
-        pass
+    async def __aenter__(self):
+        if _request_conn.get() is not None:
+            return
+        self._pool_conn = pool.connection()
+        self._token = _request_conn.set(await self._pool_conn.__aenter__())
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None:
-            conn.rollback()
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._pool_conn is None:
             return
-        conn.commit()
+        _request_conn.reset(self._token)
+        await self._pool_conn.__aexit__(exc_type, exc_val, exc_tb)
+        self._pool_conn = None
+
+
+def migrate():
+    """Initializes the database, or updates its schema, if needed"""
+    with psycopg.connect(conninfo) as migration_conn:
+        # Every gunicorn worker migrates on startup, so they take turns rather than all migrating at once
+        migration_conn.execute("SELECT pg_advisory_lock(%s)", (migration_lock_id,))
+        db_updater.ensure_schema_updated(migration_conn)
+
+
+async def open_pool():
+    """Migrates the database if needed, then opens the pool. Importing this module doesn't touch the database."""
+    await asyncio.to_thread(migrate)
+    await pool.open(wait=True)
+
+
+async def close_pool():
+    await pool.close()
+
 
+def pool_stats() -> Dict[str, int]:
+    """Pool size and checkout wait counters (requests_wait_ms, requests_waiting, etc.) for monitoring"""
+    return pool.get_stats()
 
-# Check if db has been initialized. If it hasn't been, initialize it.
-with ConnManager():
-    db_updater.ensure_schema_updated(conn)
+
+# How long a dispatched job is held before it's handed out again, and how many dispatches a job gets before it fails
+job_lease_duration = datetime.timedelta(minutes=4)
+max_job_attempts = 3
 
 
 class InvalidFormat(Exception):
@@ -57,53 +122,113 @@ class WorkNotFound(Exception):
     pass
 
 
-def work_exists(work_id: int) -> bool:
-    cursor = conn.cursor()
-    cursor.execute(f"select exists(select from works_storage where work_id = %(work_id)s)", {"work_id": work_id})
-    result = cursor.fetchone()[0]
-    cursor.close()
+@metrics.timed_query
+async def existing_works(work_ids: List[int]) -> Set[int]:
+    """Returns which of the given works have been archived"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT DISTINCT work_id FROM works_storage WHERE work_id = ANY(%(work_ids)s)
+    """, {"work_ids": work_ids}, prepare=True)
+    result = {row[0] for row in await cursor.fetchall()}
+    await cursor.close()
     return result
 
 
-def queue_work(work_id: int, updated_time: int, work_format: str, reporter_id: str, title: str = None,
-               author: str = None) -> int | None:
-    if work_format not in valid_formats:
-        raise InvalidFormat(f"{work_format} is not a valid format")
+@metrics.timed_query
+async def get_archived_work_ids() -> List[int]:
+    """Returns the id of every archived work"""
+    cursor = conn().cursor()
+    await cursor.execute("SELECT DISTINCT work_id FROM works_storage")
+    result = [row[0] for row in await cursor.fetchall()]
+    await cursor.close()
+    return result
 
-    cursor = conn.cursor()
 
-    # Check if work version is already downloaded. If so, exit.
-    cursor.execute("""
-        SELECT EXISTS(
-            SELECT FROM works_storage
-            WHERE work_id=%(work_id)s AND format=%(work_format)s AND updated_time>=%(updated_time)s
-        )
-    """, {"work_id": work_id, "work_format": work_format, "updated_time": updated_time})
-    work_exists = cursor.fetchone()[0]
-    if work_exists:
-        return None
+class WorkQueueEntry(TypedDict):
+    work_id: int
+    updated_time: int
+    work_format: str
+    reporter_id: str
+    title: str | None
+    author: str | None
 
-    # Check if work is already in queue, if so return id
-    cursor.execute("""
-        SELECT job_id
-        FROM queue
-        WHERE work_id=%(work_id)s AND format=%(work_format)s AND complete=false
-    """, {"work_id": work_id, "work_format": work_format, "updated_time": updated_time})
-    job_id = cursor.fetchone()
-    if job_id:
-        return job_id[0]
-
-    # Insert into queue
-    cursor.execute("""
-        INSERT INTO queue
-        (work_id, submitted_time, updated, submitted_by_id, format, title, author)
-        VALUES (%(work_id)s, NOW(), %(updated)s, %(submitted_by_id)s, %(format)s, %(title)s, %(author)s)
-        returning job_id
-    """, {"work_id": work_id, "updated": updated_time, "submitted_by_id": reporter_id, "format": work_format,
-          "title": title, "author": author})
-    job_id = cursor.fetchone()
-    cursor.close()
-    return job_id[0]
+
+async def queue_work(work_id: int, updated_time: int, work_format: str, reporter_id: str, title: str = None,
+                     author: str = None) -> int | None:
+    """Queues a work version, returning its job id, or None if that version is already archived"""
+    return (await queue_works([WorkQueueEntry(work_id=work_id, updated_time=updated_time, work_format=work_format,
+                                              reporter_id=reporter_id, title=title, author=author)]))[0]
+
+
+@metrics.timed_query
+async def queue_works(works: List[WorkQueueEntry]) -> List[int | None]:
+    """
+    Queues a batch of work versions. Every report is checked against the archive and queue, and missing ones are
+    inserted, in one statement. Returns the job id for each report, or None if that version is already archived.
+    """
+    for work in works:
+        if work["work_format"] not in valid_formats:
+            raise InvalidFormat(f"{work['work_format']} is not a valid format")
+    if not works:
+        return []
+
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH reports AS (
+            SELECT *
+            FROM unnest(%(work_ids)s::integer[], %(updated_times)s::bigint[], %(formats)s::varchar[],
+                        %(reporter_ids)s::varchar[], %(titles)s::varchar[], %(authors)s::varchar[])
+                WITH ORDINALITY AS r(work_id, updated, format, submitted_by_id, title, author, report_index)
+        ), pending AS (
+            SELECT reports.*, queued.job_id AS queued_job_id
+            FROM reports
+            LEFT JOIN LATERAL (
+                SELECT job_id
+                FROM queue
+                WHERE queue.work_id = reports.work_id AND queue.format = reports.format AND queue.complete = false
+                LIMIT 1
+            ) queued ON true
+            WHERE NOT EXISTS (
+                SELECT FROM works_storage
+                WHERE works_storage.work_id = reports.work_id AND works_storage.format = reports.format
+                AND works_storage.updated_time >= reports.updated
+            )
+        ), inserted AS (
+            INSERT INTO queue
+            (work_id, submitted_time, updated, submitted_by_id, format, title, author)
+            SELECT DISTINCT ON (work_id, format) work_id, NOW(), updated, submitted_by_id, format, title, author
+            FROM pending
+            WHERE queued_job_id IS NULL
+            ORDER BY work_id, format, updated DESC
+            ON CONFLICT (work_id, updated, format) WHERE complete = false DO NOTHING
+            RETURNING job_id, work_id, format
+        )
+        SELECT pending.report_index IS NOT NULL, COALESCE(pending.queued_job_id, inserted.job_id)
+        FROM reports
+        LEFT JOIN pending ON pending.report_index = reports.report_index
+        LEFT JOIN inserted ON inserted.work_id = pending.work_id AND inserted.format = pending.format
+        ORDER BY reports.report_index;
+    """, {"work_ids": [work["work_id"] for work in works],
+          "updated_times": [work["updated_time"] for work in works],
+          "formats": [work["work_format"] for work in works],
+          "reporter_ids": [work["reporter_id"] for work in works],
+          "titles": [work["title"] for work in works],
+          "authors": [work["author"] for work in works]}, prepare=True)
+    results = await cursor.fetchall()
+
+    job_ids = []
+    for work, (needs_job, job_id) in zip(works, results):
+        if needs_job and job_id is None:
+            # The job was queued by a concurrent transaction after this statement's snapshot was taken
+            await cursor.execute("""
+                SELECT job_id
+                FROM queue
+                WHERE work_id=%(work_id)s AND format=%(work_format)s AND complete=false
+            """, {"work_id": work["work_id"], "work_format": work["work_format"]})
+            job_id = (await cursor.fetchone())[0]
+        job_ids.append(job_id)
+    await cursor.close()
+    return job_ids
 
 
 class QueueStatus(Enum):
@@ -112,15 +237,16 @@ class QueueStatus(Enum):
     COMPLETED = 3
 
 
-def queue_item_status(job_id: int) -> QueueStatus:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def queue_item_status(job_id: int) -> QueueStatus:
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT complete, success
         FROM queue
         WHERE job_id=%(job_id)s
-    """, {"job_id": job_id})
-    result = cursor.fetchone()
-    cursor.close()
+    """, {"job_id": job_id}, prepare=True)
+    result = await cursor.fetchone()
+    await cursor.close()
     if not result:
         raise JobNotFound(f"Job {job_id} not found")
     complete, success = result
@@ -149,76 +275,111 @@ class JobOrder(BaseModel):
     get_img: bool = True
     cache_infos: Dict[str, ObjectCacheInfo] = {}
 
-    def model_post_init(self, __context):
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT
-                DISTINCT ON (request_url) request_url,
-                etag, creation_time, object_id, sha1
-            FROM object_index
-            WHERE associated_work = %s
-            ORDER BY request_url, creation_time DESC
-            LIMIT 200;
-        """, (self.work_id,))
-        result = cursor.fetchall()
-        cursor.close()
-        self.cache_infos = {
-            row[0]: ObjectCacheInfo(url=row[0], etag=row[1], time=row[2], object_id=row[3], sha1=row[4])
-            for row in result}
-
-
-def get_job(client_name: str) -> None | JobOrder:
-    cursor = conn.cursor()
-
-    cursor.execute("""
-    SELECT job_id, work_id, format, updated
-    FROM queue
-    WHERE complete = false AND NOT EXISTS (
-        SELECT
-        FROM dispatches
-        WHERE dispatches.job_id = queue.job_id
-        AND dispatches.dispatched_time > (NOW() - INTERVAL '00:04:00')
-    )
-    ORDER BY queue.submitted_time DESC
-    LIMIT 1;
-    """)
-    queue_query = cursor.fetchone()
-    cursor.close()
 
-    if not queue_query:
+async def get_job(client_name: str) -> None | JobOrder:
+    jobs = await get_jobs(client_name, 1)
+    if not jobs:
         return None
+    return jobs[0]
+
+
+async def get_jobs(client_name: str, max_jobs: int) -> List[JobOrder]:
+    """Leases up to max_jobs of the newest jobs that aren't leased out, along with the cache infos of their images"""
+    results = await lease_jobs(client_name, max_jobs)
+    if not results:
+        return []
+
+    cache_infos = await get_cache_infos([result[3] for result in results])
+    return [JobOrder(dispatch_id=dispatch_id,
+                     job_id=job_id,
+                     work_id=work_id,
+                     work_format=work_format,
+                     report_code=report_code,
+                     updated=updated,
+                     get_img=True,
+                     cache_infos=cache_infos.get(work_id, {}))
+            for dispatch_id, report_code, job_id, work_id, work_format, updated in results]
 
-    job_id, work_id, work_format, updated = queue_query
-
-    fail_count = get_queue_dispatch_count(job_id)
-    if fail_count >= 3:
-        mark_queue_completed(job_id, False)
-        return get_job(client_name)
-
-    dispatch_id, report_code = dispatch_job(job_id, client_name)
-    job_order = JobOrder(dispatch_id=dispatch_id,
-                         job_id=job_id,
-                         work_id=work_id,
-                         work_format=work_format,
-                         report_code=report_code,
-                         updated=updated,
-                         get_img=True)
-    return job_order
-
-
-def dispatch_job(job_id: int, client_name: str) -> tuple[int, int]:
-    cursor = conn.cursor()
-    report_code = random.randrange(-32768, 32767)
-    cursor.execute("""
-                    INSERT INTO dispatches
-                    (dispatched_time, dispatched_to_name, job_id, report_code)
-                    VALUES (NOW(), %(client_name)s, %(job_id)s, %(report_code)s)
-                    RETURNING dispatch_id;
-                   """, {"client_name": client_name, "job_id": job_id,
-                         "report_code": report_code})
-    dispatch_id = cursor.fetchone()[0]
-    cursor.close()
-    return dispatch_id, report_code
+
+@metrics.timed_query
+async def lease_jobs(client_name: str, max_jobs: int) -> List[tuple[int, int, int, int, str, int]]:
+    """
+    Leases up to max_jobs of the newest jobs that aren't leased out, and records a dispatch for each, in one statement.
+    Row locks are skipped rather than waited on, so concurrent requests never get handed the same job. Jobs that used
+    up their attempts and whose last lease ran out are retired by the same statement. Returns (dispatch_id,
+    report_code, job_id, work_id, format, updated) for each leased job.
+    """
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH retired AS (
+            UPDATE queue
+            SET complete = true, success = false
+            WHERE job_id IN (
+                SELECT job_id
+                FROM queue
+                WHERE complete = false AND leased_until < NOW() AND attempt_count >= %(max_attempts)s
+                LIMIT 100
+                FOR UPDATE SKIP LOCKED
+            )
+        ), claimed AS (
+            UPDATE queue
+            SET attempt_count = attempt_count + 1, leased_until = NOW() + %(lease_duration)s
+            WHERE job_id IN (
+                SELECT job_id
+                FROM queue
+                WHERE complete = false AND attempt_count < %(max_attempts)s
+                AND (leased_until IS NULL OR leased_until < NOW())
+                ORDER BY submitted_time DESC
+                LIMIT %(max_jobs)s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING job_id, work_id, format, updated, submitted_time
+        ), dispatched AS (
+            INSERT INTO dispatches
+            (dispatched_time, dispatched_to_name, job_id, report_code)
+            SELECT NOW(), %(client_name)s, job_id, (floor(random() * 65535) - 32768)::smallint
+            FROM claimed
+            RETURNING dispatch_id, job_id, report_code
+        )
+        SELECT dispatched.dispatch_id, dispatched.report_code, claimed.job_id, claimed.work_id, claimed.format,
+        claimed.updated
+        FROM dispatched
+        INNER JOIN claimed ON claimed.job_id = dispatched.job_id
+        ORDER BY claimed.submitted_time DESC;
+    """, {"client_name": client_name, "max_attempts": max_job_attempts, "lease_duration": job_lease_duration,
+          "max_jobs": max_jobs}, prepare=True)
+    results = await cursor.fetchall()
+    await cursor.close()
+    return results
+
+
+@metrics.timed_query
+async def get_cache_infos(work_ids: List[int]) -> Dict[int, Dict[str, ObjectCacheInfo]]:
+    """Gets the newest cache info of each object url, up to 200 urls per work, for every given work at once"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT associated_work, request_url, etag, creation_time, object_id, sha1
+        FROM (
+            SELECT associated_work, request_url, etag, creation_time, object_id, sha1,
+            row_number() OVER (PARTITION BY associated_work ORDER BY request_url) AS url_number
+            FROM (
+                SELECT
+                    DISTINCT ON (associated_work, request_url) associated_work, request_url,
+                    etag, creation_time, object_id, sha1
+                FROM object_index
+                WHERE associated_work = ANY(%(work_ids)s)
+                ORDER BY associated_work, request_url, creation_time DESC
+            ) newest_objects
+        ) numbered_objects
+        WHERE url_number <= 200;
+    """, {"work_ids": work_ids}, prepare=True)
+    results = await cursor.fetchall()
+    await cursor.close()
+    cache_infos = {}
+    for row in results:
+        cache_infos.setdefault(row[0], {})[row[1]] = ObjectCacheInfo(url=row[1], etag=row[2], time=row[3],
+                                                                     object_id=row[4], sha1=row[5])
+    return cache_infos
 
 
 class NotAuthorized(Exception):
@@ -236,15 +397,16 @@ class AlreadyReported(Exception):
     """This is used when something is already reported and did not have any reason to be reported again"""
 
 
-def mark_dispatch_fail(dispatch_id: int, fail_code: int, report_code: int):
-    cursor = conn.cursor()
+@metrics.timed_query
+async def mark_dispatch_fail(dispatch_id: int, fail_code: int, report_code: int):
+    cursor = conn().cursor()
 
-    cursor.execute("""
+    await cursor.execute("""
         SELECT report_code, fail_reported, job_id
         FROM dispatches
         WHERE dispatch_id = %s AND fail_reported = false
     """, (dispatch_id,))
-    dispatch_data = cursor.fetchone()
+    dispatch_data = await cursor.fetchone()
 
     if dispatch_data is None:
         raise JobNotFound("invalid dispatch id provided")
@@ -257,58 +419,108 @@ def mark_dispatch_fail(dispatch_id: int, fail_code: int, report_code: int):
     if fail_reported:
         raise AlreadyReported(f"A fail has already been marked for dispatch id {dispatch_id}")
 
-    cursor.execute("""
+    await cursor.execute("""
         UPDATE dispatches
         SET fail_reported = true, fail_status = %(fail_status)s, complete = true
         WHERE dispatch_id = %(dispatch_id)s;
     """, {"fail_status": fail_code, "dispatch_id": dispatch_id, "job_id": job_id})
 
-    fail_count = get_queue_dispatch_count(job_id)
-    if fail_count >= 3:
-        mark_queue_completed(job_id, False)
+    # The failed lease is given up so the job can be retried right away, unless it's out of attempts. A late report
+    # from a dispatch whose lease already expired and was handed out again leaves the newer dispatch's lease alone.
+    await cursor.execute("""
+        UPDATE queue
+        SET leased_until = NULL, complete = complete OR attempt_count >= %(max_attempts)s
+        WHERE job_id = %(job_id)s AND NOT EXISTS (
+            SELECT FROM dispatches
+            WHERE dispatches.job_id = %(job_id)s AND dispatches.dispatch_id > %(dispatch_id)s
+        );
+    """, {"max_attempts": max_job_attempts, "job_id": job_id, "dispatch_id": dispatch_id})
 
-    cursor.close()
+    await cursor.close()
 
 
-def get_queue_dispatch_count(job_id: int) -> int:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*)
-        FROM dispatches
-        WHERE job_id = %s;
-    """, (job_id,))
-    fail_count = cursor.fetchone()[0]
-    cursor.close()
-    return fail_count
+@metrics.timed_query
+async def get_queue_stats() -> Dict[str, int | float]:
+    """Queue depth, lease ages and the recent dispatch failure rate, for metrics"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT
+            COUNT(*) FILTER (WHERE leased_until IS NULL OR leased_until <= NOW()),
+            COUNT(*) FILTER (WHERE leased_until > NOW()),
+            GREATEST(EXTRACT(EPOCH FROM NOW() - MIN(submitted_time)
+                             FILTER (WHERE leased_until IS NULL OR leased_until <= NOW())), 0),
+            COALESCE(EXTRACT(EPOCH FROM NOW() - MIN(leased_until - %(lease_duration)s)
+                             FILTER (WHERE leased_until > NOW())), 0),
+            (SELECT COALESCE(AVG(fail_reported::integer), 0)
+             FROM dispatches
+             WHERE dispatched_time > NOW() - INTERVAL '1 hour')
+        FROM queue
+        WHERE complete = false;
+    """, {"lease_duration": job_lease_duration})
+    result = await cursor.fetchone()
+    await cursor.close()
+    return {"waiting": result[0], "leased": result[1], "oldest_waiting_seconds": float(result[2]),
+            "oldest_lease_seconds": float(result[3]), "failure_ratio": float(result[4])}
 
 
 class WorkBulkEntry(TypedDict):
     work_id: int
     title: str
+    format: NotRequired[str]
 
 
-def add_storage_entry(work_id: int, uploaded_time: int, updated_time: int, location: str, retrieved_from: str,
-                      file_format: str, sha1: str, title: str = None, author: str = None, patch_of: int = None) -> int:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def add_storage_entry(work_id: int, uploaded_time: int, updated_time: int, location: str, retrieved_from: str,
+                            file_format: str, sha1: str, title: str = None, author: str = None,
+                            patch_of: int = None, chunked: bool = False) -> int:
+    cursor = conn().cursor()
+    await cursor.execute("""
         INSERT INTO works_storage
-        (work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, sha1, title, author)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        (work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, sha1, title, author, chunked)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         RETURNING storage_id;
-    """, [work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, file_format, sha1, title, author])
-    storage_id = cursor.fetchone()[0]
-    cursor.close()
+    """, [work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, file_format, sha1, title, author,
+          chunked])
+    storage_id = (await cursor.fetchone())[0]
+    await cursor.close()
     return storage_id
 
 
-def update_storage_patch(storage_id: int, patch_of: int):
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def update_storage_patch(storage_id: int, patch_of: int, keyframe: bool = False, delta_codec: str = "bsdiff"):
+    """
+    Points a storage entry at the version after it. Keyframes keep their full contents rather than a diff, otherwise
+    delta_codec is the codec the diff was made with.
+    """
+    cursor = conn().cursor()
+    await cursor.execute("""
         UPDATE works_storage
-        SET patch_of = %(patch_of)s
+        SET patch_of = %(patch_of)s, keyframe = %(keyframe)s, delta_codec = %(delta_codec)s
         WHERE storage_id = %(storage_id)s;
-    """, {"patch_of": patch_of, "storage_id": storage_id})
-    cursor.close()
+    """, {"patch_of": patch_of, "keyframe": keyframe, "delta_codec": delta_codec, "storage_id": storage_id})
+    await cursor.close()
+
+
+@metrics.timed_query
+async def count_diffs_since_keyframe(storage_id: int) -> int:
+    """Counts the diff entries older than the given entry that are patched back from it, up to the last keyframe"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH RECURSIVE older AS (
+            SELECT storage_id
+            FROM works_storage
+            WHERE patch_of = %(storage_id)s AND NOT keyframe
+            UNION ALL
+            SELECT ws.storage_id
+            FROM works_storage ws
+            INNER JOIN older ON ws.patch_of = older.storage_id
+            WHERE NOT ws.keyframe
+        )
+        SELECT COUNT(*) FROM older;
+    """, {"storage_id": storage_id})
+    result = (await cursor.fetchone())[0]
+    await cursor.close()
+    return result
 
 
 class StorageData(BaseModel):
@@ -323,6 +535,9 @@ class StorageData(BaseModel):
     title: str | None
     img_enabled: bool
     sha1: str
+    keyframe: bool
+    chunked: bool
+    delta_codec: str
 
 
 def parse_storage_query(result) -> StorageData | None:
@@ -331,57 +546,249 @@ def parse_storage_query(result) -> StorageData | None:
 
     return StorageData(storage_id=result[0], work_id=result[1], uploaded_time=result[2], updated_time=result[3],
                        location=result[4], patch_of=result[5], retrieved_from=result[6], format=result[7],
-                       title=result[8], img_enabled=result[9], sha1=result[10])
+                       title=result[8], img_enabled=result[9], sha1=result[10], keyframe=result[11],
+                       chunked=result[12], delta_codec=result[13])
 
 
-def get_head_work_storage_data(work_id: int, file_format: str) -> StorageData | None:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def get_head_work_storage_data(work_id: int, file_format: str) -> StorageData | None:
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT storage_id, work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, title,
-        img_enabled, sha1
+        img_enabled, sha1, keyframe, chunked, delta_codec
         FROM works_storage
         WHERE work_id = %(work_id)s AND format = %(format)s AND patch_of IS NULL
         LIMIT 1;
-    """, {"work_id": work_id, "format": file_format})
-    result = cursor.fetchone()
-    cursor.close()
+    """, {"work_id": work_id, "format": file_format}, prepare=True)
+    result = await cursor.fetchone()
+    await cursor.close()
 
     return parse_storage_query(result)
 
 
-def get_storage_entry(storage_id: int) -> StorageData | None:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def get_head_works_storage_data(works: List[tuple[int, str]]) -> Dict[tuple[int, str], StorageData]:
+    """Batch version of get_head_work_storage_data. Takes (work_id, format) pairs and returns the entries found."""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT ws.storage_id, ws.work_id, ws.uploaded_time, ws.updated_time, ws.location, ws.patch_of,
+        ws.retrieved_from, ws.format, ws.title, ws.img_enabled, ws.sha1, ws.keyframe, ws.chunked, ws.delta_codec
+        FROM unnest(%(work_ids)s::integer[], %(formats)s::varchar[]) AS requested(work_id, format)
+        INNER JOIN works_storage ws
+        ON ws.work_id = requested.work_id AND ws.format = requested.format AND ws.patch_of IS NULL;
+    """, {"work_ids": [work[0] for work in works], "formats": [work[1] for work in works]})
+    results = await cursor.fetchall()
+    await cursor.close()
+    storage_entries = [parse_storage_query(result) for result in results]
+    return {(entry.work_id, entry.format): entry for entry in storage_entries}
+
+
+@metrics.timed_query
+async def get_storage_entry(storage_id: int) -> StorageData | None:
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT storage_id, work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, title,
-        img_enabled, sha1
+        img_enabled, sha1, keyframe, chunked, delta_codec
         FROM works_storage
         WHERE storage_id = %(storage_id)s
-    """, {"storage_id": storage_id})
-    result = cursor.fetchone()
-    cursor.close()
+    """, {"storage_id": storage_id}, prepare=True)
+    result = await cursor.fetchone()
+    await cursor.close()
 
     return parse_storage_query(result)
 
 
-def mark_queue_completed(job_id: int, success: bool):
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def find_existing_chunks(sha1s: List[str]) -> set[str]:
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT sha1
+        FROM chunk_store
+        WHERE sha1 = ANY(%(sha1s)s);
+    """, {"sha1s": sha1s})
+    results = await cursor.fetchall()
+    await cursor.close()
+    return {result[0] for result in results}
+
+
+@metrics.timed_query
+async def add_chunks(chunks: List[tuple[str, str, int]]) -> None:
+    """Registers (sha1, location, size) chunks. Chunks that are already registered are left alone."""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        INSERT INTO chunk_store (sha1, location, size)
+        SELECT * FROM unnest(%(sha1s)s::char(40)[], %(locations)s::varchar[], %(sizes)s::integer[])
+        ON CONFLICT (sha1) DO NOTHING;
+    """, {"sha1s": [chunk[0] for chunk in chunks], "locations": [chunk[1] for chunk in chunks],
+          "sizes": [chunk[2] for chunk in chunks]})
+    await cursor.close()
+
+
+@metrics.timed_query
+async def add_work_chunks(storage_id: int, sha1s: List[str]) -> None:
+    """Writes the chunk manifest of a chunked storage entry"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        INSERT INTO work_chunks (storage_id, chunk_index, sha1)
+        SELECT %(storage_id)s, chunk_index - 1, sha1
+        FROM unnest(%(sha1s)s::char(40)[]) WITH ORDINALITY AS manifest(sha1, chunk_index);
+    """, {"storage_id": storage_id, "sha1s": sha1s})
+    await cursor.close()
+
+
+@metrics.timed_query
+async def get_work_chunk_locations(storage_id: int) -> List[str]:
+    """Gets the storage locations of a chunked entry's chunks, in order"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT cs.location
+        FROM work_chunks wc
+        INNER JOIN chunk_store cs ON cs.sha1 = wc.sha1
+        WHERE wc.storage_id = %(storage_id)s
+        ORDER BY wc.chunk_index;
+    """, {"storage_id": storage_id}, prepare=True)
+    results = await cursor.fetchall()
+    await cursor.close()
+    return [result[0] for result in results]
+
+
+@metrics.timed_query
+async def mark_storage_chunked(storage_id: int) -> None:
+    """Switches an entry over to its chunk manifest. Chunked entries hold full contents, so they act as keyframes."""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        UPDATE works_storage
+        SET chunked = true, keyframe = patch_of IS NOT NULL
+        WHERE storage_id = %(storage_id)s;
+    """, {"storage_id": storage_id})
+    await cursor.close()
+
+
+@metrics.timed_query
+async def get_storage_page(chunked: bool, before_storage_id: int | None, limit: int) -> List[StorageData]:
+    """Pages through storage entries from newest to oldest, for maintenance tools"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT storage_id, work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, title,
+        img_enabled, sha1, keyframe, chunked, delta_codec
+        FROM works_storage
+        WHERE chunked = %(chunked)s AND (%(before)s::integer IS NULL OR storage_id < %(before)s)
+        ORDER BY storage_id DESC
+        LIMIT %(limit)s;
+    """, {"chunked": chunked, "before": before_storage_id, "limit": limit})
+    results = await cursor.fetchall()
+    await cursor.close()
+    return [parse_storage_query(result) for result in results]
+
+
+@metrics.timed_query
+async def location_in_use(location: str) -> bool:
+    """Checks if any unchunked storage entry still keeps its contents at the given location"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT EXISTS(SELECT FROM works_storage WHERE location = %(location)s AND NOT chunked);
+    """, {"location": location})
+    result = (await cursor.fetchone())[0]
+    await cursor.close()
+    return result
+
+
+@metrics.timed_query
+async def get_chunk_stats() -> tuple[int, int, int]:
+    """Returns the number of stored chunks, their total size, and the total size of all chunked versions"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM chunk_store),
+            (SELECT COALESCE(SUM(size), 0) FROM chunk_store),
+            (SELECT COALESCE(SUM(cs.size), 0) FROM work_chunks wc INNER JOIN chunk_store cs ON cs.sha1 = wc.sha1);
+    """)
+    result = await cursor.fetchone()
+    await cursor.close()
+    return result
+
+
+@metrics.timed_query
+async def get_chunk_page(after_sha1: str | None, limit: int) -> List[tuple[str, str]]:
+    """Pages through the (sha1, location) of stored chunks, for maintenance tools"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT sha1, location
+        FROM chunk_store
+        WHERE %(after)s::varchar IS NULL OR sha1 > %(after)s
+        ORDER BY sha1
+        LIMIT %(limit)s;
+    """, {"after": after_sha1, "limit": limit})
+    results = await cursor.fetchall()
+    await cursor.close()
+    return results
+
+
+@metrics.timed_query
+async def get_patch_chain(storage_id: int, max_length: int = 100) -> List[StorageData]:
+    """
+    Fetches the storage entry and every entry needed to rebuild it in one query. Ordered from the requested entry to
+    the entry holding full contents (either the head or a keyframe). The chain is cut off after max_length entries.
+    """
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH RECURSIVE chain AS (
+            SELECT storage_id, work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, title,
+            img_enabled, sha1, keyframe, chunked, delta_codec, 1 AS depth
+            FROM works_storage
+            WHERE storage_id = %(storage_id)s
+            UNION ALL
+            SELECT ws.storage_id, ws.work_id, ws.uploaded_time, ws.updated_time, ws.location, ws.patch_of,
+            ws.retrieved_from, ws.format, ws.title, ws.img_enabled, ws.sha1, ws.keyframe, ws.chunked, ws.delta_codec,
+            chain.depth + 1
+            FROM works_storage ws
+            INNER JOIN chain ON ws.storage_id = chain.patch_of
+            WHERE NOT chain.keyframe AND chain.depth < %(max_length)s
+        )
+        SELECT storage_id, work_id, uploaded_time, updated_time, location, patch_of, retrieved_from, format, title,
+        img_enabled, sha1, keyframe, chunked, delta_codec
+        FROM chain
+        ORDER BY depth;
+    """, {"storage_id": storage_id, "max_length": max_length}, prepare=True)
+    results = await cursor.fetchall()
+    await cursor.close()
+    return [parse_storage_query(result) for result in results]
+
+
+@metrics.timed_query
+async def mark_queue_completed(job_id: int, success: bool):
+    cursor = conn().cursor()
+    await cursor.execute("""
         UPDATE queue
         SET complete = true, success = %(success)s
         WHERE job_id = %(job_id)s
     """, {"job_id": job_id, "success": success})
-    cursor.close()
+    await cursor.close()
 
 
 class SupportingObject(BaseModel):
+    """A supporting object upload. The data stays in its (spooled) file, so it's never held in memory whole."""
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     url: str
     etag: str
     mimetype: str
     file_name: str
-    data: bytes
+    file: SkipValidation[BinaryIO]
+    sha1: str
+    size: int
 
-    def data_sha1(self) -> str:
-        return hashlib.sha1(self.data).hexdigest()
+    @classmethod
+    def from_file(cls, url: str, etag: str, mimetype: str, file_name: str, file: BinaryIO) -> "SupportingObject":
+        """Hashes the file in chunks, then rewinds it so it can be uploaded"""
+        sha1 = hashlib.sha1()
+        size = 0
+        while chunk := file.read(256 * 1024):
+            sha1.update(chunk)
+            size += len(chunk)
+        file.seek(0)
+        return cls(url=url, etag=etag, mimetype=mimetype, file_name=file_name, file=file, sha1=sha1.hexdigest(),
+                   size=size)
 
 
 class SupportingCachedObject(BaseModel):
@@ -389,87 +796,230 @@ class SupportingCachedObject(BaseModel):
     object_id: int
 
 
-def submit_dispatch(dispatch_id: int, report_code: int, work: bytes,
-                    supporting_objects: List[SupportingObject | SupportingCachedObject]) -> None:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def get_dispatch_job(dispatch_id: int) -> tuple[int, int] | None:
+    """Returns the report code and job id of a dispatch that hasn't been reported as failed"""
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT report_code, job_id
         FROM dispatches
         WHERE dispatch_id = %(dispatch_id)s AND fail_reported = false
     """, {"dispatch_id": dispatch_id})
-    result = cursor.fetchone()
-    cursor.close()
-
-    true_report_code, job_id = result
-
-    if true_report_code is None:
-        raise JobNotFound("Invalid job_id provided")
+    result = await cursor.fetchone()
+    await cursor.close()
+    return result
 
-    if report_code != true_report_code:
-        raise NotAuthorized("You did not provide the proper report code for this work job")
 
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def get_queued_work(job_id: int) -> tuple[int, int, str, str, str | None, str | None]:
+    """Returns the work_id, updated time, submitter, format, title and author of a queued job"""
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT work_id, updated, submitted_by_id, format, title, author
         FROM queue
         WHERE job_id = %(job_id)s
     """, {"job_id": job_id})
-    result = cursor.fetchone()
-    cursor.close()
+    result = await cursor.fetchone()
+    await cursor.close()
+    return result
 
-    work_id, updated_time, submitted_by, file_format, title, author = result
+
+@metrics.timed_query
+async def mark_dispatch_complete(job_id: int, found_as_duplicate: bool) -> None:
+    cursor = conn().cursor()
+    await cursor.execute("""
+        UPDATE dispatches
+        SET complete = true, found_as_duplicate = found_as_duplicate OR %(found_as_duplicate)s
+        WHERE job_id = %(job_id)s
+    """, {"job_id": job_id, "found_as_duplicate": found_as_duplicate})
+    await cursor.close()
+
+
+async def submit_dispatch(dispatch_id: int, report_code: int, work: bytes,
+                          supporting_objects: List[SupportingObject | SupportingCachedObject]) -> None:
+    result = await get_dispatch_job(dispatch_id)
+    if result is None:
+        raise JobNotFound("Invalid job_id provided")
+
+    true_report_code, job_id = result
+
+    if report_code != true_report_code:
+        raise NotAuthorized("You did not provide the proper report code for this work job")
+
+    work_id, updated_time, submitted_by, file_format, title, author = await get_queued_work(job_id)
 
     from file_storage import storage
     from storage_managers import DuplicateDetected
     try:
-        storage.store_work(work_id, work, int(time.time()), updated_time, submitted_by, file_format, supporting_objects,
-                           title, author)
+        await storage.store_work(work_id, work, int(time.time()), updated_time, submitted_by, file_format,
+                                 supporting_objects, title, author)
     except DuplicateDetected:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE dispatches
-            SET complete = true, found_as_duplicate = true
-            WHERE job_id = %(job_id)s
-        """, {"job_id": job_id})
-        cursor.close()
+        await mark_dispatch_complete(job_id, True)
     else:
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE dispatches
-            SET complete = true
-            WHERE job_id = %(job_id)s
-        """, {"job_id": job_id})
-        cursor.close()
-    mark_queue_completed(job_id, True)
-
-
-def sideload_work(work_id, work, updated_time, submitted_by, file_format,
-                  supporting_objects: List[SupportingObject | SupportingCachedObject]):
+        await mark_dispatch_complete(job_id, False)
+    await mark_queue_completed(job_id, True)
+
+
+async def sideload_work(work_id, work, updated_time, submitted_by, file_format,
+                        supporting_objects: List[SupportingObject | SupportingCachedObject]):
     from file_storage import storage
-    storage.store_work(work_id, work, int(time.time()), updated_time, submitted_by, file_format, supporting_objects)
+    await storage.store_work(work_id, work, int(time.time()), updated_time, submitted_by, file_format,
+                             supporting_objects)
 
 
 re_clean_filename = re.compile(r"[/\\?%*:|\"<>\x7F\x00-\x1F]")
 
 
-def get_bulk_works(works: List[WorkBulkEntry]):
-    from file_storage import storage
-    failed_works = []
+# Prepared bulk downloads are shared between workers through the bulk_downloads table and expire after this long
+bulk_download_ttl = datetime.timedelta(seconds=int(os.environ.get("BULK_DOWNLOAD_TTL", 3600)))
+bulk_download_max_works = int(os.environ.get("BULK_DOWNLOAD_MAX_WORKS", 1000))
+
+
+@metrics.timed_query
+async def create_bulk_download(works: List[WorkBulkEntry]) -> str:
+    """Stores a prepared bulk download and returns its id. Expired downloads are cleaned up along the way."""
+    dl_id = uuid.uuid4().hex
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH expired AS (
+            DELETE FROM bulk_downloads
+            WHERE dl_id IN (
+                SELECT dl_id
+                FROM bulk_downloads
+                WHERE expires_time < NOW()
+                LIMIT 100
+                FOR UPDATE SKIP LOCKED
+            )
+        )
+        INSERT INTO bulk_downloads (dl_id, works, expires_time)
+        VALUES (%(dl_id)s, %(works)s, NOW() + %(ttl)s);
+    """, {"dl_id": dl_id, "works": Jsonb(works), "ttl": bulk_download_ttl})
+    await cursor.close()
+    return dl_id
+
+
+@metrics.timed_query
+async def get_bulk_download(dl_id: str) -> List[WorkBulkEntry] | None:
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT works
+        FROM bulk_downloads
+        WHERE dl_id = %(dl_id)s AND expires_time > NOW();
+    """, {"dl_id": dl_id}, prepare=True)
+    result = await cursor.fetchone()
+    await cursor.close()
+    if result is None:
+        return None
+    return result[0]
+
+
+# How many works a bulk download fetches ahead of the one being written, and how many fetched bytes it may hold
+bulk_prefetch_count = int(os.environ.get("BULK_PREFETCH_COUNT", 8))
+bulk_prefetch_bytes = int(os.environ.get("BULK_PREFETCH_BYTES", 64 * 1024 ** 2))
+bulk_chunk_size = 256 * 1024
+# Threads that write bulk zips. A writer blocks while the works it's zipping are fetched, and fetches use the default
+# executor, so writers get their own threads: if they shared the default executor, enough concurrent downloads would
+# leave no thread free to fetch with, and every download would wait forever.
+bulk_zip_executor = ThreadPoolExecutor(int(os.environ.get("BULK_ZIP_THREADS", 8)), thread_name_prefix="bulk-zip")
+
+
+async def stream_zip_in_executor(files, executor: Executor):
+    """
+    stream_zip's async_stream_zip, except that the zip is written on executor rather than the default executor.
+    files is an async iterable of member files, each with an async iterable of their contents.
+    """
+    loop = asyncio.get_running_loop()
 
-    def work_files():
-        for work in works:
-            work_contents = storage.get_work_by_lookup(work["work_id"])
-            if work_contents is False:
-                failed_works.append(work)
-                continue
+    def to_sync_iterable(async_iterable):
+        iterator = async_iterable.__aiter__()
 
-            def work_bytes_gen():
-                yield work_contents
+        async def get_next():
+            return await iterator.__anext__()
 
-            file_name = re_clean_filename.sub('-', f"{work['title']} ({work['work_id']}).pdf")
-            yield file_name, datetime.datetime.now(), S_IFREG | 0o600, ZIP_64, work_bytes_gen()
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(get_next(), loop).result()
+            except StopAsyncIteration:
+                return
 
-    return stream_zip(work_files())
+    member_files = (member_file[:4] + (to_sync_iterable(member_file[4]),) for member_file in to_sync_iterable(files))
+    chunks = stream_zip(member_files)
+    done = object()
+    while (chunk := await loop.run_in_executor(executor, next, chunks, done)) is not done:
+        yield chunk
+
+
+def get_bulk_works(works: List[WorkBulkEntry]):
+    """
+    Streams a zip of the newest copy of every requested work. Works are fetched concurrently ahead of the zip writer,
+    but written in the order requested. Works that couldn't be fetched are listed in a failed_works.txt file.
+    """
+    from file_storage import storage
+
+    async def fetch(storage_entry: StorageData | None) -> bytes | None:
+        if storage_entry is None:
+            return None
+        try:
+            return await storage.get_full_work(storage_entry)
+        except Exception as e:
+            print(f"Failed to fetch {storage_entry.location} for bulk download: {e!r}")
+            return None
+
+    async def work_files():
+        # The zip is streamed after the endpoint returns, so this checks out its own connection.
+        async with ConnManager():
+            storage_entries = await get_head_works_storage_data(
+                [(work["work_id"], work.get("format", "html")) for work in works])
+
+        pending = deque()
+        works_left = iter(works)
+
+        def fill_pipeline():
+            buffered_bytes = sum(len(task.result() or b"") for _, task in pending
+                                 if task.done() and not task.cancelled())
+            while len(pending) < bulk_prefetch_count and buffered_bytes < bulk_prefetch_bytes:
+                work = next(works_left, None)
+                if work is None:
+                    return
+                storage_entry = storage_entries.get((work["work_id"], work.get("format", "html")))
+                pending.append((work, asyncio.create_task(fetch(storage_entry))))
+
+        failed_works = []
+        try:
+            fill_pipeline()
+            while pending:
+                work, task = pending.popleft()
+                work_contents = await task
+                if work_contents is None:
+                    failed_works.append(work)
+                    fill_pipeline()
+                    continue
+
+                async def work_bytes_gen(data=work_contents):
+                    view = memoryview(data)
+                    for offset in range(0, len(view), bulk_chunk_size):
+                        yield bytes(view[offset:offset + bulk_chunk_size])
+                        fill_pipeline()  # Keep fetching ahead while this work is being written
+
+                file_format = work.get("format", "html")
+                file_name = re_clean_filename.sub('-', f"{work['title']} ({work['work_id']}).{file_format}")
+                yield file_name, datetime.datetime.now(), S_IFREG | 0o600, ZIP_64, work_bytes_gen()
+                del work_contents
+                fill_pipeline()
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+        if failed_works:
+            manifest = "The following works could not be downloaded:\n" + "".join(
+                f"{work['title']} ({work['work_id']})\n" for work in failed_works)
+
+            async def manifest_gen():
+                yield manifest.encode("utf-8")
+
+            yield "failed_works.txt", datetime.datetime.now(), S_IFREG | 0o600, ZIP_64, manifest_gen()
+
+    return stream_zip_in_executor(work_files(), bulk_zip_executor)
 
 
 class Work(BaseModel):
@@ -499,16 +1049,17 @@ class Work(BaseModel):
         return datetime.datetime.fromtimestamp(self.uploaded_time).strftime('%c')
 
 
-def get_work_versions(work_id: int) -> List[Work]:
-    cursor = conn.cursor()
-    cursor.execute("""
+@metrics.timed_query
+async def get_work_versions(work_id: int) -> List[Work]:
+    cursor = conn().cursor()
+    await cursor.execute("""
         SELECT storage_id, work_id, format, uploaded_time, updated_time, location, patch_of, retrieved_from
         FROM works_storage
         WHERE work_id = %(work_id)s
         ORDER BY uploaded_time DESC;
     """, {"work_id": work_id})
-    results = cursor.fetchall()
-    cursor.close()
+    results = await cursor.fetchall()
+    await cursor.close()
     works = [Work(
         storage_id=result[0],
         work_id=result[1],
@@ -522,68 +1073,96 @@ def get_work_versions(work_id: int) -> List[Work]:
     return works
 
 
-def object_exists(sha1: str):
-    cursor = conn.cursor()
-    cursor.execute("SELECT EXISTS(SELECT FROM object_store WHERE sha1 = %s)", (sha1,))
-    result = cursor.fetchone()
-    cursor.close()
-    return result[0]
-
-
-def create_object_entry(sha1: str, location: str):
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO object_store (sha1, location) VALUES (%(sha1)s, %(location)s);
-    """, {"sha1": sha1, "location": location})
-    cursor.close()
-
-
-def find_object_index_entry(sha1: str, request_url: str, etag: str | None, associated_work: int) -> int | None:
-    """For checking to see if an entry already sufficiently describes what is to be inserted"""
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT object_id
-        FROM object_index
-        WHERE request_url = %(request_url)s AND etag=%(etag)s AND sha1=%(sha1)s AND associated_work=%(associated_work)s
-    """, {"sha1": sha1, "request_url": request_url, "etag": etag, "associated_work": associated_work})
-    result = cursor.fetchone()
-    cursor.close()
-    if result is None:
-        return None
-    return result[0]
-
-
-def create_object_index_entry(sha1: str, request_url: str, etag: str | None, associated_work: int, mimetype: str) -> int:
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO object_index (request_url, sha1, etag, mimetype, associated_work)
-        VALUES (%(request_url)s, %(sha1)s, %(etag)s, %(mimetype)s, %(associated_work)s)
-        RETURNING object_id;
-    """, {"sha1": sha1, "request_url": request_url, "etag": etag, "associated_work": associated_work, "mimetype": mimetype})
-    result = cursor.fetchone()
-    cursor.close()
-    return result[0]
+@metrics.timed_query
+async def find_existing_objects(sha1s: List[str]) -> set[str]:
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT sha1
+        FROM object_store
+        WHERE sha1 = ANY(%(sha1s)s);
+    """, {"sha1s": sha1s})
+    results = await cursor.fetchall()
+    await cursor.close()
+    return {result[0] for result in results}
+
+
+@metrics.timed_query
+async def add_object_entries(objects: List[tuple[str, str]]) -> None:
+    """Adds (sha1, location) entries to the object store, skipping any that are already there"""
+    cursor = conn().cursor()
+    await cursor.execute("""
+        INSERT INTO object_store (sha1, location)
+        SELECT * FROM unnest(%(sha1s)s::varchar[], %(locations)s::varchar[])
+        ON CONFLICT (sha1) DO NOTHING;
+    """, {"sha1s": [sha1 for sha1, _ in objects], "locations": [location for _, location in objects]})
+    await cursor.close()
+
+
+class ObjectIndexEntry(TypedDict):
+    request_url: str
+    sha1: str
+    etag: str | None
+    mimetype: str
 
 
-class SupportingObjectData(BaseModel):
+@metrics.timed_query
+async def add_object_index_entries(entries: List[ObjectIndexEntry],
+                                   associated_work: int) -> Dict[tuple[str, str, str | None], int]:
+    """
+    Finds or creates the object index entry for each (request_url, sha1, etag) of a work, in one statement.
+    Returns the object id of each.
+    """
+    cursor = conn().cursor()
+    await cursor.execute("""
+        WITH input AS (
+            SELECT DISTINCT ON (request_url, sha1, etag) request_url, sha1, etag, mimetype, position
+            FROM unnest(%(request_urls)s::varchar[], %(sha1s)s::char(40)[], %(etags)s::varchar[],
+                        %(mimetypes)s::varchar[]) WITH ORDINALITY AS i(request_url, sha1, etag, mimetype, position)
+            ORDER BY request_url, sha1, etag, position
+        ), existing AS (
+            SELECT DISTINCT ON (i.request_url, i.sha1, i.etag) i.request_url, i.sha1, i.etag, oi.object_id
+            FROM input i
+            INNER JOIN object_index oi ON oi.request_url = i.request_url AND oi.sha1 = i.sha1
+                AND oi.etag IS NOT DISTINCT FROM i.etag AND oi.associated_work = %(associated_work)s
+            ORDER BY i.request_url, i.sha1, i.etag, oi.object_id
+        ), inserted AS (
+            INSERT INTO object_index (request_url, sha1, etag, mimetype, associated_work)
+            SELECT i.request_url, i.sha1, i.etag, i.mimetype, %(associated_work)s
+            FROM input i
+            WHERE NOT EXISTS(SELECT FROM existing e
+                             WHERE e.request_url = i.request_url AND e.sha1 = i.sha1 AND e.etag IS NOT DISTINCT FROM i.etag)
+            ORDER BY i.position
+            RETURNING request_url, sha1, etag, object_id
+        )
+        SELECT request_url, sha1, etag, object_id FROM existing
+        UNION ALL
+        SELECT request_url, sha1, etag, object_id FROM inserted;
+    """, {"request_urls": [entry["request_url"] for entry in entries], "sha1s": [entry["sha1"] for entry in entries],
+          "etags": [entry["etag"] for entry in entries], "mimetypes": [entry["mimetype"] for entry in entries],
+          "associated_work": associated_work})
+    results = await cursor.fetchall()
+    await cursor.close()
+    return {(request_url, sha1, etag): object_id for request_url, sha1, etag, object_id in results}
+
+
+class SupportingObjectInfo(BaseModel):
     mimetype: str
     location: str
-    data: bytes
+    sha1: str
 
 
-def get_supporting_object_file(obj_id: int) -> SupportingObjectData | None:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT oi.mimetype, os.location
+@metrics.timed_query
+async def get_supporting_object_info(obj_id: int) -> SupportingObjectInfo | None:
+    cursor = conn().cursor()
+    await cursor.execute("""
+        SELECT oi.mimetype, os.location, os.sha1
         FROM object_index oi
         INNER JOIN object_store os on os.sha1 = oi.sha1
         WHERE oi.object_id = %s
         LIMIT 1
-    """, (obj_id,))
-    result = cursor.fetchone()
-    cursor.close()
+    """, (obj_id,), prepare=True)
+    result = await cursor.fetchone()
+    await cursor.close()
     if result is None:
         return None
-    from file_storage import storage
-    data = storage.get_file(result[1])
-    return SupportingObjectData(mimetype=result[0], location=result[1], data=data)
+    return SupportingObjectInfo(mimetype=result[0], location=result[1], sha1=result[2])
@@ -1,4 +1,4 @@
-CURRENT_VERSION = 2
+CURRENT_VERSION = 10
 
 
 def get_db_version(conn):
@@ -68,6 +68,167 @@ def ensure_schema_updated(conn):
             INSERT INTO public.version_info (version)
             VALUES (2);
         """)
+    elif version == 2:  # Migration script for version 2 -> 3
+        init_cursor.execute("""
+            alter table works_storage
+                add keyframe boolean default false not null;
+
+            create index storage_patch_of_index
+                on works_storage (patch_of);
+
+            UPDATE version_info SET version = 3;
+        """)
+    elif version == 3:  # Migration script for version 3 -> 4
+        init_cursor.execute("""
+            alter table queue
+                add leased_until TIMESTAMP(0) WITHOUT TIME ZONE;
+
+            alter table queue
+                add attempt_count integer default 0 not null;
+
+            UPDATE queue
+            SET attempt_count = d.attempts, leased_until = d.last_dispatch + INTERVAL '00:04:00'
+            FROM (
+                SELECT job_id, COUNT(*) AS attempts, MAX(dispatched_time) AS last_dispatch
+                FROM dispatches
+                GROUP BY job_id
+            ) d
+            WHERE queue.job_id = d.job_id AND queue.complete = false;
+
+            create index queue_claim_index
+                on queue (submitted_time desc)
+                where complete = false;
+
+            create index queue_lease_index
+                on queue (leased_until)
+                where complete = false;
+
+            UPDATE version_info SET version = 4;
+        """)
+    elif version == 4:  # Migration script for version 4 -> 5
+        init_cursor.execute("""
+            create table bulk_downloads
+            (
+                dl_id        varchar(32)                                  not null
+                    constraint bulk_downloads_pk
+                        primary key,
+                works        jsonb                                        not null,
+                created_time TIMESTAMP(0) WITHOUT TIME ZONE default NOW() not null,
+                expires_time TIMESTAMP(0) WITHOUT TIME ZONE               not null
+            );
+
+            create index bulk_downloads_expires_time_index
+                on bulk_downloads (expires_time);
+
+            UPDATE version_info SET version = 5;
+        """)
+    elif version == 5:  # Migration script for version 5 -> 6
+        init_cursor.execute("""
+            alter table works_storage
+                add chunked boolean default false not null;
+
+            create table chunk_store
+            (
+                sha1     char(40)     not null
+                    constraint chunk_store_pk
+                        primary key,
+                location varchar(255) not null,
+                size     integer      not null
+            );
+
+            create table work_chunks
+            (
+                storage_id  integer  not null
+                    constraint work_chunks_works_storage_storage_id_fk
+                        references works_storage,
+                chunk_index integer  not null,
+                sha1        char(40) not null
+                    constraint work_chunks_chunk_store_sha1_fk
+                        references chunk_store,
+                constraint work_chunks_pk
+                    primary key (storage_id, chunk_index)
+            );
+
+            create index work_chunks_sha1_index
+                on work_chunks (sha1);
+
+            UPDATE version_info SET version = 6;
+        """)
+    elif version == 6:  # Migration script for version 6 -> 7
+        init_cursor.execute("""
+            alter table works_storage
+                add delta_codec varchar(32) default 'bsdiff' not null;
+
+            UPDATE version_info SET version = 7;
+        """)
+    elif version == 7:  # Migration script for version 7 -> 8
+        init_cursor.execute("""
+            create function notify_job_complete() returns trigger as $$
+            begin
+                perform pg_notify('job_complete', NEW.job_id::text);
+                return NEW;
+            end;
+            $$ language plpgsql;
+
+            create trigger queue_complete_notify
+                after update of complete on queue
+                for each row
+                when (NEW.complete and not OLD.complete)
+                execute function notify_job_complete();
+
+            UPDATE version_info SET version = 8;
+        """)
+    elif version == 8:  # Migration script for version 8 -> 9
+        init_cursor.execute("""
+            create function notify_new_jobs() returns trigger as $$
+            declare
+                job_count integer;
+            begin
+                select count(*) into job_count from new_jobs;
+                if job_count > 0 then
+                    perform pg_notify('new_job', job_count::text);
+                end if;
+                return null;
+            end;
+            $$ language plpgsql;
+
+            create trigger queue_insert_notify
+                after insert on queue
+                referencing new table as new_jobs
+                for each statement
+                execute function notify_new_jobs();
+
+            create function notify_released_job() returns trigger as $$
+            begin
+                perform pg_notify('new_job', '1');
+                return NEW;
+            end;
+            $$ language plpgsql;
+
+            create trigger queue_release_notify
+                after update of leased_until on queue
+                for each row
+                when (NEW.leased_until is null and OLD.leased_until is not null and not NEW.complete)
+                execute function notify_released_job();
+
+            UPDATE version_info SET version = 9;
+        """)
+    elif version == 9:  # Migration script for version 9 -> 10
+        init_cursor.execute("""
+            create function notify_work_archived() returns trigger as $$
+            begin
+                perform pg_notify('work_archived', NEW.work_id::text);
+                return NEW;
+            end;
+            $$ language plpgsql;
+
+            create trigger works_storage_insert_notify
+                after insert on works_storage
+                for each row
+                execute function notify_work_archived();
+
+            UPDATE version_info SET version = 10;
+        """)
 
     init_cursor.close()
     conn.commit()
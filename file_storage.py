@@ -1,3 +1,17 @@
+import os
 import storage_managers
 
-storage = storage_managers.S3Manager()
+storage_backend = os.environ.get("STORAGE_BACKEND", "s3")
+
+if storage_backend == "s3":
+    storage = storage_managers.S3Manager()
+elif storage_backend == "memory":
+    storage = storage_managers.MemoryManager()
+elif storage_backend == "filesystem":
+    storage = storage_managers.FilesystemManager()
+else:
+    raise ValueError(f"Unknown storage backend '{storage_backend}'")
+
+# Optional read-through cache on local disk in front of the backend
+if os.environ.get("STORAGE_CACHE_DIR"):
+    storage = storage_managers.CachingManager.from_env(storage)
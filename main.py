@@ -1,20 +1,41 @@
+import asyncio
 import itertools
-import uuid
+import os
+from contextlib import asynccontextmanager
 import db
 from fastapi import FastAPI, HTTPException, Request, status, File, Form, UploadFile, Depends
-from fastapi.responses import Response, RedirectResponse, StreamingResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
+from prometheus_fastapi_instrumentator import Instrumentator
+from pydantic import BaseModel, Field
 from typing import List
-from cacheout import Cache
 from typing import Annotated
+from archived_works import archived_works
 from auth import admin_token
+from cacheout import Cache
+import metrics
+import notifications
+import storage_managers
+import streaming
 from file_storage import storage
 
-app = FastAPI()
-bulk_dl_tasks_cache = Cache(maxsize=50)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await db.open_pool()
+    await notifications.listener.start()
+    yield
+    await notifications.listener.stop()
+    await db.close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+# Uploaded files bigger than this are spooled to disk while the form is parsed, capping memory use per upload
+MultiPartParser.max_file_size = int(os.environ.get("UPLOAD_SPOOL_BYTES", 1024 * 1024))
 templates = Jinja2Templates(directory="templates/")
+Instrumentator(excluded_handlers=["/metrics"]).instrument(app)
 
 origins = [
     "http://127.0.0.1:8000",
@@ -39,28 +60,99 @@ class WorkReport(BaseModel):
     author: str = None
 
 
+# Recent report results, keyed by (work_id, format, updated_time). Popular works are reported over and over, so repeats
+# of an archived or queued version are answered without the database. Within the ttl a queued job may have finished.
+report_cache = Cache(maxsize=int(os.environ.get("REPORT_CACHE_SIZE", 100_000)),
+                     ttl=float(os.environ.get("REPORT_CACHE_TTL", 60)))
+_not_cached = object()
+
+
 @app.post("/report_work")
 async def report_work(work: WorkReport):
-    with db.ConnManager():
-        job_id = db.queue_work(work.work_id, work.updated_time, work.format, work.reporter, work.title, work.author)
+    key = (work.work_id, work.format, work.updated_time)
+    job_id = report_cache.get(key, _not_cached)
+    if job_id is _not_cached:
+        async with db.ConnManager():
+            job_id = await db.queue_work(work.work_id, work.updated_time, work.format, work.reporter, work.title,
+                                         work.author)
+        report_cache.set(key, job_id)
     if job_id is None:
         return {"status": "already fetched"}
     return {"status": "queued", "job_id": job_id}
 
 
+class WorkReportBatch(BaseModel):
+    works: List[WorkReport] = Field(max_length=1000)
+
+
+@app.post("/report_works")
+async def report_works(work_batch: WorkReportBatch):
+    """Batch version of /report_work, for reporting a whole list of works in one request"""
+    valid_works = [work for work in work_batch.works if work.format in db.valid_formats]
+    valid_job_ids = {}
+    uncached_works = []
+    for work in valid_works:
+        job_id = report_cache.get((work.work_id, work.format, work.updated_time), _not_cached)
+        if job_id is _not_cached:
+            uncached_works.append(work)
+        else:
+            valid_job_ids[id(work)] = job_id
+
+    if uncached_works:
+        async with db.ConnManager():
+            job_ids = await db.queue_works([
+                db.WorkQueueEntry(work_id=work.work_id, updated_time=work.updated_time, work_format=work.format,
+                                  reporter_id=work.reporter, title=work.title, author=work.author)
+                for work in uncached_works])
+        for work, job_id in zip(uncached_works, job_ids):
+            valid_job_ids[id(work)] = job_id
+            report_cache.set((work.work_id, work.format, work.updated_time), job_id)
+
+    results = []
+    for work in work_batch.works:
+        if id(work) not in valid_job_ids:
+            results.append({"work_id": work.work_id, "status": "invalid format"})
+        elif valid_job_ids[id(work)] is None:
+            results.append({"work_id": work.work_id, "status": "already fetched"})
+        else:
+            results.append({"work_id": work.work_id, "status": "queued", "job_id": valid_job_ids[id(work)]})
+    return {"results": results}
+
+
 @app.get("/work_exists/{work_id}")
 async def work_exists(work_id: int):
-    with db.ConnManager():
-        return {"exists": db.work_exists(work_id)}
+    return {"exists": work_id in await archived_works.existing([work_id])}
+
+
+class WorkExistsBatch(BaseModel):
+    work_ids: List[int] = Field(max_length=1000)
+
+
+@app.post("/works_exist")
+async def works_exist(batch: WorkExistsBatch):
+    """Batch version of /work_exists, for checking every work on a listing page in one request"""
+    existing = await archived_works.existing(batch.work_ids)
+    return {"results": [{"work_id": work_id, "exists": work_id in existing} for work_id in batch.work_ids]}
 
 
 @app.get("/job_status")
-async def job_status(job_id: int):
-    try:
-        with db.ConnManager():
-            job_status = db.queue_item_status(job_id)
-    except db.JobNotFound:
-        raise HTTPException(status_code=404, detail="Job not found")
+async def job_status(job_id: int, wait: float = 0):
+    """
+    With wait, a queued job's status is held for up to that many seconds (capped at notifications.max_wait) until the
+    job finishes, rather than returned right away.
+    """
+    with notifications.job_completions.waiter(str(job_id)) as job_completed:
+        try:
+            async with db.ConnManager():
+                job_status = await db.queue_item_status(job_id)
+        except db.JobNotFound:
+            raise HTTPException(status_code=404, detail="Job not found")
+
+        # The connection is given back while waiting
+        if (job_status == db.QueueStatus.IN_QUEUE and wait > 0 and
+                await notifications.wait_for(job_completed, min(wait, notifications.max_wait))):
+            async with db.ConnManager():
+                job_status = await db.queue_item_status(job_id)
 
     if job_status == db.QueueStatus.IN_QUEUE:
         return {"status": "queued", "job_id": job_id}
@@ -72,17 +164,46 @@ async def job_status(job_id: int):
 
 class JobRequest(BaseModel):
     client_name: str = "Unknown"
+    max_jobs: int = Field(default=1, ge=1, le=100)
+    # Seconds to hold the request open for a job to arrive if the queue is empty (capped at notifications.max_wait)
+    wait: float = Field(default=0, ge=0)
+
+
+async def claim_jobs(job_request: JobRequest) -> List[db.JobOrder]:
+    """Claims jobs, waiting up to job_request.wait seconds for new ones if there are none"""
+    if job_request.wait <= 0:
+        async with db.ConnManager():
+            return await db.get_jobs(job_request.client_name, job_request.max_jobs)
+
+    deadline = asyncio.get_running_loop().time() + min(job_request.wait, notifications.max_wait)
+    retrying = False
+    while True:
+        # The waiter is registered before claiming, so a job queued in between still wakes it
+        with notifications.job_requests.waiter(first=retrying) as job_available:
+            async with db.ConnManager():
+                jobs = await db.get_jobs(job_request.client_name, job_request.max_jobs)
+            remaining = deadline - asyncio.get_running_loop().time()
+            if not jobs and remaining > 0 and await notifications.wait_for(job_available, remaining):
+                retrying = True
+                continue
+            # Done waiting, so a wake up that arrived while claiming or timing out is passed on to the next waiter
+            if job_available.is_set():
+                notifications.job_requests.notify_one()
+            return jobs
 
 
 @app.post("/request_job", dependencies=[Depends(admin_token)])
 async def request_job(job_request: JobRequest):
-    with db.ConnManager():
-        job = db.get_job(job_request.client_name)
+    jobs = await claim_jobs(job_request)
 
-    if job is None:
+    # Clients asking for several jobs get a list back, even when it only has one job in it
+    if job_request.max_jobs > 1:
+        return {"status": "jobs assigned" if jobs else "queue empty", "jobs": [job.dict() for job in jobs]}
+
+    if not jobs:
         return {"status": "queue empty"}
 
-    return {"status": "job assigned", **job.dict()}
+    return {"status": "job assigned", **jobs[0].dict()}
 
 
 class JobFailure(BaseModel):
@@ -94,8 +215,8 @@ class JobFailure(BaseModel):
 @app.post("/job_fail", dependencies=[Depends(admin_token)])
 async def fail_job(job: JobFailure):
     try:
-        with db.ConnManager():
-            db.mark_dispatch_fail(job.dispatch_id, job.fail_status, job.report_code)
+        async with db.ConnManager():
+            await db.mark_dispatch_fail(job.dispatch_id, job.fail_status, job.report_code)
     except db.NotAuthorized:
         raise HTTPException(status_code=403, detail="not authorized to report failure")
     except db.AlreadyReported:
@@ -127,7 +248,8 @@ async def extract_supporting_objects(form_data) -> List[db.SupportingObject | db
             raise HTTPException(status_code=400, detail="missing url or etag data")
         mimetype = file.headers.get("Content-Type", "")
         file_name = file.filename
-        supporting_object = db.SupportingObject(url=url, etag=etag, mimetype=mimetype, file_name=file_name, data=await file.read())
+        supporting_object = await asyncio.to_thread(db.SupportingObject.from_file, url, etag, mimetype, file_name,
+                                                    file.file)
         supporting_data.append(supporting_object)
     return supporting_data
 
@@ -142,8 +264,8 @@ async def complete_job(dispatch_id: Annotated[int, Form()],
     supporting_objects = await extract_supporting_objects(form_data)
 
     try:
-        with db.ConnManager():
-            db.submit_dispatch(dispatch_id, report_code, await work.read(), supporting_objects)
+        async with db.ConnManager():
+            await db.submit_dispatch(dispatch_id, report_code, await work.read(), supporting_objects)
     except db.NotAuthorized:
         raise HTTPException(status_code=403, detail="not authorized to submit job")
     except db.AlreadyReported:
@@ -164,16 +286,16 @@ async def submit_work(work_id: Annotated[int, Form()],
     form_data = await request.form()
     supporting_objects = await extract_supporting_objects(form_data)
 
-    with db.ConnManager():
-        db.sideload_work(work_id, await work.read(), updated_time, requester_id, file_format, supporting_objects)
+    async with db.ConnManager():
+        await db.sideload_work(work_id, await work.read(), updated_time, requester_id, file_format, supporting_objects)
     return {"status": "successfully submitted"}
 
 
 @app.get("/works/{work_id}")
 async def get_work(work_id: int, request: Request, version: int = None):
     if version is None:
-        with db.ConnManager():
-            work_history = db.get_work_versions(work_id)
+        async with db.ConnManager():
+            work_history = await db.get_work_versions(work_id)
         if len(work_history) == 0:
             raise HTTPException(status_code=404, detail="work not found")
         newest_work = work_history.pop(0)
@@ -184,47 +306,80 @@ async def get_work(work_id: int, request: Request, version: int = None):
             context={"newest_work": newest_work, "work_history": work_history, "request": request},
         )
 
-    with db.ConnManager():
-        work, storage_data = storage.get_work(version)
-    if work is None:
-        raise HTTPException(status_code=404, detail="version not found")
-    if storage_data.work_id != work_id:
-        raise HTTPException(status_code=400, detail="invalid request")
-    return Response(content=work,
-                    media_type=db.format_mimetypes[storage_data.format],
-                    headers={"Cache-Control": "max-age=31536000, immutable"})
+    async with db.ConnManager():
+        storage_entry = await db.get_storage_entry(version)
+        if storage_entry is None:
+            raise HTTPException(status_code=404, detail="version not found")
+        if storage_entry.work_id != work_id:
+            raise HTTPException(status_code=400, detail="invalid request")
+        etag = streaming.make_etag(storage_entry.sha1)
+        if streaming.etag_matches(request, etag):
+            return streaming.not_modified(etag)
+        work, storage_data = await storage.get_work(version)
+    return streaming.bytes_response(request, work, db.format_mimetypes[storage_data.format], etag)
 
 
 @app.get("/objects/{obj_id}")
-async def get_object(obj_id: int):
-    with db.ConnManager():
-        supporting_object = db.get_supporting_object_file(obj_id)
+async def get_object(obj_id: int, request: Request):
+    async with db.ConnManager():
+        object_info = await db.get_supporting_object_info(obj_id)
 
-    if supporting_object is None:
+    if object_info is None:
         raise HTTPException(status_code=404, detail="not found.")
 
-    return Response(content=supporting_object.data,
-                    media_type=supporting_object.mimetype,
-                    headers={"Cache-Control": "max-age=31536000, immutable"})
+    etag = streaming.make_etag(object_info.sha1)
+    if streaming.etag_matches(request, etag):
+        return streaming.not_modified(etag)
+    return await streaming.storage_response(request, storage, object_info.location, object_info.mimetype, etag)
 
 
 class BulkRequest(BaseModel):
-    works: List[db.WorkBulkEntry]
+    works: List[db.WorkBulkEntry] = Field(max_length=db.bulk_download_max_works)
 
 
 @app.post("/works/dl/bulk_prepare")
 async def bulk_download_prep(work_requests: BulkRequest):
-    dl_key = uuid.uuid4().hex
-    bulk_dl_tasks_cache.set(dl_key, work_requests.works)
+    async with db.ConnManager():
+        dl_key = await db.create_bulk_download(work_requests.works)
     return {"dl_id": dl_key}
 
 
 @app.get("/works/dl/bulk_dl/{dl_id}")
 async def bulk_download(dl_id: str):
-    works = bulk_dl_tasks_cache.get(dl_id)
+    async with db.ConnManager():
+        works = await db.get_bulk_download(dl_id)
     if not works:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Download not valid, please initiate a new download or check that you have the right url.")
     zip_res = db.get_bulk_works(works)
     return StreamingResponse(content=zip_res, media_type="application/zip")
+
+
+@app.get("/db_pool_stats", dependencies=[Depends(admin_token)])
+async def db_pool_stats():
+    return db.pool_stats()
+
+
+@app.get("/cache_stats", dependencies=[Depends(admin_token)])
+async def cache_stats():
+    stats = {"version_cache": storage.version_cache.stats()}
+    if isinstance(storage, storage_managers.CachingManager):
+        stats["storage_cache"] = storage.stats()
+    return stats
+
+
+# Queue stats scan the whole queue, and /metrics is public, so they're computed at most once per ttl per process
+queue_stats_cache = Cache(maxsize=1, ttl=float(os.environ.get("QUEUE_STATS_TTL", 15)))
+queue_stats_lock = asyncio.Lock()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    async with queue_stats_lock:
+        queue_stats = queue_stats_cache.get("queue_stats")
+        if queue_stats is None:
+            async with db.ConnManager():
+                queue_stats = await db.get_queue_stats()
+            queue_stats_cache.set("queue_stats", queue_stats)
+    return Response(metrics.render(queue_stats), media_type=metrics.content_type)
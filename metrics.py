@@ -0,0 +1,74 @@
+"""
+Prometheus metrics. When running under several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty directory
+(cleared on every start) so each worker's metrics are written there and /metrics can aggregate all of them.
+"""
+import functools
+import os
+import time
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess,
+                               CONTENT_TYPE_LATEST)
+from prometheus_client.core import GaugeMetricFamily
+
+content_type = CONTENT_TYPE_LATEST
+
+db_query_seconds = Histogram("ao3_saver_db_query_seconds", "Time spent in each db.py query function", ["function"],
+                             buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+storage_seconds = Histogram("ao3_saver_storage_seconds", "Time spent on object storage requests", ["operation"],
+                            buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+storage_bytes = Counter("ao3_saver_storage_bytes", "Bytes transferred to and from object storage", ["operation"])
+patch_chain_length = Histogram("ao3_saver_patch_chain_length", "Diffs applied to rebuild a requested version",
+                               buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+delta_seconds = Histogram("ao3_saver_delta_seconds", "Time spent creating and applying diffs between versions",
+                          ["codec", "operation"], buckets=(.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+
+def timed_query(func):
+    """Records the duration of every call of an async db function"""
+    histogram = db_query_seconds.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+class _Collected:
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+def render(queue_stats: dict) -> bytes:
+    """
+    Renders every metric in the text format. Queue stats are read from the database at scrape time rather than
+    tracked by each worker, so they're passed in.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    jobs = GaugeMetricFamily("ao3_saver_queue_jobs", "Incomplete jobs in the queue", labels=["state"])
+    jobs.add_metric(["waiting"], queue_stats["waiting"])
+    jobs.add_metric(["leased"], queue_stats["leased"])
+    families = [
+        jobs,
+        GaugeMetricFamily("ao3_saver_queue_oldest_waiting_seconds", "Age of the oldest job waiting to be leased",
+                          value=queue_stats["oldest_waiting_seconds"]),
+        GaugeMetricFamily("ao3_saver_queue_oldest_lease_seconds", "Age of the oldest active job lease",
+                          value=queue_stats["oldest_lease_seconds"]),
+        GaugeMetricFamily("ao3_saver_dispatch_failure_ratio",
+                          "Share of dispatches in the last hour that were reported as failed",
+                          value=queue_stats["failure_ratio"]),
+    ]
+    queue_registry = CollectorRegistry()
+    queue_registry.register(_Collected(families))
+    return generate_latest(registry) + generate_latest(queue_registry)
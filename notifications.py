@@ -0,0 +1,160 @@
+"""
+Postgres LISTEN/NOTIFY for the app. Each worker process keeps one listening connection and fans the notifications it
+receives out to the requests waiting on them, so waiting requests don't hold a pool connection or poll the database.
+"""
+import asyncio
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, List, Set
+import psycopg
+import db
+
+max_wait = 60  # Longest a request may wait for a notification, in seconds. Kept well below the worker timeout.
+# Jobs also become available when leases expire, which doesn't notify, so a waiting request is woken this often to check
+lease_recheck_interval = 15
+
+
+class Listener:
+    def __init__(self, conninfo: str):
+        self.conninfo = conninfo
+        self.handlers: Dict[str, List[Callable[[str | None], None]]] = defaultdict(list)
+        self.timers: List[tuple[float, Callable[[], None]]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def on(self, channel: str, handler: Callable[[str | None], None]) -> None:
+        """
+        Calls handler with the payload of every notification on channel. It's called with None after (re)connecting,
+        as notifications may have been missed while disconnected.
+        """
+        self.handlers[channel].append(handler)
+
+    def every(self, interval: float, callback: Callable[[], None]) -> None:
+        """Calls callback every interval seconds while the listener runs"""
+        self.timers.append((interval, callback))
+
+    async def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._run())]
+        self._tasks.extend(asyncio.create_task(self._run_timer(interval, callback))
+                           for interval, callback in self.timers)
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    async def _run_timer(interval: float, callback: Callable[[], None]) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                callback()
+            except Exception as e:
+                print(f"Notification timer {callback!r} failed: {e!r}")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True) as conn:
+                    for channel in self.handlers:
+                        await conn.execute(f"LISTEN {channel}")
+                    self._dispatch_all(None)
+                    async for notify in conn.notifies():
+                        for handler in self.handlers[notify.channel]:
+                            self._call(handler, notify.payload)
+            except psycopg.Error as e:
+                print(f"Notification listener lost its connection, reconnecting: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch_all(self, payload: str | None) -> None:
+        for handlers in self.handlers.values():
+            for handler in handlers:
+                self._call(handler, payload)
+
+    @staticmethod
+    def _call(handler: Callable[[str | None], None], payload: str | None) -> None:
+        # A failing handler is logged rather than raised, so it can't stop the listener or the handlers after it
+        try:
+            handler(payload)
+        except Exception as e:
+            print(f"Notification handler {handler!r} failed on {payload!r}: {e!r}")
+
+
+class KeyedWaiters:
+    """Requests waiting for a notification with a specific payload, ex: the id of the job they're watching"""
+    def __init__(self):
+        self.waiters: Dict[str, Set[asyncio.Event]] = defaultdict(set)
+
+    def notify(self, key: str | None) -> None:
+        """Wakes everything waiting on key, or every waiter if key is None"""
+        keys = list(self.waiters) if key is None else [key]
+        for key in keys:
+            for event in self.waiters.get(key, ()):
+                event.set()
+
+    @contextmanager
+    def waiter(self, key: str):
+        """
+        Registers a waiter for key. Register before checking whatever the notification is about, so a notification
+        arriving between the check and the wait isn't missed.
+        """
+        event = asyncio.Event()
+        self.waiters[key].add(event)
+        try:
+            yield event
+        finally:
+            self.waiters[key].discard(event)
+            if not self.waiters[key]:
+                del self.waiters[key]
+
+
+class FifoWaiters:
+    """
+    Requests waiting for something to be available, ex: a job to claim. A notification carrying a count wakes that
+    many waiters, oldest first, rather than all of them at once.
+    """
+    def __init__(self):
+        self.waiters: Deque[asyncio.Event] = deque()
+
+    def notify(self, count: str | None = "1") -> None:
+        """Wakes the count oldest waiters, or every waiter if count is None"""
+        wake = len(self.waiters) if count is None else int(count)
+        for _ in range(min(wake, len(self.waiters))):
+            self.waiters.popleft().set()
+
+    def notify_one(self) -> None:
+        self.notify("1")
+
+    @contextmanager
+    def waiter(self, first: bool = False):
+        """
+        Registers a waiter, which is removed from the queue once woken. A waiter that was woken but found nothing can
+        register again with first, so it keeps its place at the front.
+        """
+        event = asyncio.Event()
+        if first:
+            self.waiters.appendleft(event)
+        else:
+            self.waiters.append(event)
+        try:
+            yield event
+        finally:
+            if not event.is_set():
+                self.waiters.remove(event)
+
+
+async def wait_for(event: asyncio.Event, timeout: float) -> bool:
+    """Waits for an event for up to timeout seconds, returning whether it was set"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+listener = Listener(db.conninfo)
+job_completions = KeyedWaiters()
+listener.on("job_complete", job_completions.notify)
+job_requests = FifoWaiters()
+listener.on("new_job", job_requests.notify)
+listener.every(lease_recheck_interval, job_requests.notify_one)
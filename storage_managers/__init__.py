@@ -1,2 +1,5 @@
 from .base_manager import StorageManager, TooManyIterations, DuplicateDetected
 from .s3_manager import S3Manager
+from .memory_manager import MemoryManager
+from .filesystem_manager import FilesystemManager
+from .caching_manager import CachingManager
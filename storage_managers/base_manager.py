@@ -1,17 +1,36 @@
+import asyncio
 import hashlib
-import html
+import os
 from abc import ABC, abstractmethod
-from typing import List
-from db import (get_head_work_storage_data, add_storage_entry, update_storage_patch,
-                get_storage_entry, WorkNotFound, SupportingObject, object_exists, create_object_entry,
-                create_object_index_entry, find_object_index_entry, SupportingCachedObject, StorageData)
+from concurrent.futures import Executor
+from typing import List, Dict, AsyncIterator, BinaryIO
+from db import (get_head_work_storage_data, add_storage_entry, update_storage_patch, count_diffs_since_keyframe,
+                get_patch_chain, find_existing_chunks, add_chunks, add_work_chunks, get_work_chunk_locations,
+                ConnManager, WorkNotFound, SupportingObject, find_existing_objects, add_object_entries,
+                add_object_index_entries, SupportingCachedObject, StorageData)
+import metrics
+import time
 import uuid
-import bsdiff4
-import zlib
-from bs4.dammit import UnicodeDammit
+from .version_cache import VersionCache
+from .chunking import split_chunks_async
+from .compression import compress, decompress
+from .delta_codecs import delta_codecs, choose_delta_codec
+from .html_rewriter import SourceRewriter, SourceNotFound
 
 
 class StorageManager(ABC):
+    # Max number of transfers a batch helper will have in flight at once
+    batch_concurrency = int(os.environ.get("STORAGE_BATCH_CONCURRENCY", 16))
+    # Executor used to run the blocking file functions from async code. None uses the event loop's default executor.
+    executor: Executor | None = None
+    # A full copy of a work is kept every this many versions, so rebuilding an old version never needs more diffs
+    keyframe_interval = int(os.environ.get("KEYFRAME_INTERVAL", 10))
+    # Reconstructed versions, shared by every storage manager in the process
+    version_cache = VersionCache.from_env()
+    # Store new versions as deduplicated content-defined chunks instead of a full copy plus reverse diffs. Chunking runs
+    # in CHUNKING_PROCESSES separate processes, about 0.25 s per MB each.
+    chunked_storage = os.environ.get("CHUNKED_STORAGE", "false") == "true"
+
     @abstractmethod
     def store_file(self, key: str, data: bytes) -> None:
         pass
@@ -24,100 +43,223 @@ class StorageManager(ABC):
     def get_file(self, key: str) -> bytes:
         pass
 
+    def store_fileobj(self, key: str, file: BinaryIO) -> None:
+        """Stores the contents of a file object. Backends that can upload without reading it whole should override this."""
+        self.store_file(key, file.read())
+
     def store_file_compressed(self, key: str, data: bytes) -> None:
-        self.store_file(key, zlib.compress(data))
+        self.store_file(key, compress(data))
 
     def get_file_compressed(self, key: str) -> bytes:
-        return zlib.decompress(self.get_file(key))
+        return decompress(self.get_file(key))
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def store_file_async(self, key: str, data: bytes) -> None:
+        await self.run_blocking(self.store_file, key, data)
+
+    async def store_fileobj_async(self, key: str, file: BinaryIO) -> None:
+        await self.run_blocking(self.store_fileobj, key, file)
+
+    async def delete_file_async(self, key: str) -> None:
+        await self.run_blocking(self.delete_file, key)
+
+    async def get_file_async(self, key: str) -> bytes:
+        return await self.run_blocking(self.get_file, key)
+
+    def get_file_size(self, key: str) -> int:
+        return len(self.get_file(key))
+
+    async def get_file_size_async(self, key: str) -> int:
+        return await self.run_blocking(self.get_file_size, key)
+
+    def local_path(self, key: str) -> str | None:
+        """The path of a file on local disk, for backends that keep one, so it can be served without reading it in"""
+        return None
+
+    async def stream_file_async(self, key: str, start: int = 0, stop: int | None = None,
+                                chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        """
+        Yields the file, or the [start, stop) slice of it, in chunks. This default fetches the whole file first;
+        backends that can read ranges should override it.
+        """
+        view = memoryview(await self.get_file_async(key))[start:stop]
+        for offset in range(0, len(view), chunk_size):
+            yield bytes(view[offset:offset + chunk_size])
+
+    async def store_file_compressed_async(self, key: str, data: bytes) -> None:
+        await self.store_file_async(key, await asyncio.to_thread(compress, data))
+
+    async def get_file_compressed_async(self, key: str) -> bytes:
+        return await asyncio.to_thread(decompress, await self.get_file_async(key))
+
+    async def _bounded_gather(self, coroutines) -> list:
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[run(coroutine) for coroutine in coroutines])
+
+    async def store_files_async(self, files: Dict[str, bytes]) -> None:
+        await self._bounded_gather([self.store_file_async(key, data) for key, data in files.items()])
 
-    def store_work(self, work_id: int, work: bytes, uploaded_time: int, updated_time: int, retrieved_from: str,
-                   file_format: str, supporting_objects: List[SupportingObject | SupportingCachedObject],
-                   title: str = None, author: str = None) -> None:
+    async def store_fileobjs_async(self, files: Dict[str, BinaryIO]) -> None:
+        await self._bounded_gather([self.store_fileobj_async(key, file) for key, file in files.items()])
+
+    async def get_files_async(self, keys: List[str]) -> List[bytes]:
+        return await self._bounded_gather([self.get_file_async(key) for key in keys])
+
+    async def get_files_compressed_async(self, keys: List[str]) -> List[bytes]:
+        return await self._bounded_gather([self.get_file_compressed_async(key) for key in keys])
+
+    async def store_work(self, work_id: int, work: bytes, uploaded_time: int, updated_time: int, retrieved_from: str,
+                         file_format: str, supporting_objects: List[SupportingObject | SupportingCachedObject],
+                         title: str = None, author: str = None) -> None:
         if supporting_objects:
             if file_format != 'html':
                 raise NotImplemented("Cannot handle supporting objects with non-html files.")
-            work = self.rewrite_html_sources(work, supporting_objects, work_id)
+            work = await self.rewrite_html_sources(work, supporting_objects, work_id)
 
-        previous_head_work = get_head_work_storage_data(work_id, file_format)
+        previous_head_work = await get_head_work_storage_data(work_id, file_format)
         work_sha1 = hashlib.sha1(work).hexdigest()
         if previous_head_work is not None and previous_head_work.sha1 == work_sha1:
             raise DuplicateDetected("The work being stored was found to be a duplicate.")
         storage_key = f"{work_id}_{work_sha1}"
-        self.store_file_compressed(storage_key, work)
-        storage_id = add_storage_entry(work_id, uploaded_time, updated_time, storage_key, retrieved_from, file_format,
-                                       work_sha1, title, author)
-
-        if previous_head_work is not None:  # Create diff file to maintain history
-            old_work = self.get_file_compressed(previous_head_work.location)
-            diff = bsdiff4.diff(work, old_work)
-            self.store_file_compressed(previous_head_work.location, diff)
-            update_storage_patch(previous_head_work.storage_id, storage_id)
-
-    def get_work_by_lookup(self, work_id: int, file_format: str) -> bytes | None:
-        head_work = get_head_work_storage_data(work_id, file_format)
+
+        if self.chunked_storage:
+            # The location is only nominal, the contents are in the chunk manifest
+            storage_id = await add_storage_entry(work_id, uploaded_time, updated_time, storage_key, retrieved_from,
+                                                 file_format, work_sha1, title, author, chunked=True)
+            await self.store_chunks(storage_id, work)
+            if previous_head_work is not None:
+                # Unchanged chunks are shared with the old head, so it keeps its contents instead of becoming a diff
+                await update_storage_patch(previous_head_work.storage_id, storage_id, True)
+            return
+
+        if previous_head_work is None:
+            await self.store_file_compressed_async(storage_key, work)
+            await add_storage_entry(work_id, uploaded_time, updated_time, storage_key, retrieved_from, file_format,
+                                    work_sha1, title, author)
+            return
+
+        # Once enough diffs have piled up behind the old head, it's kept whole as a keyframe instead of diffed.
+        # Chunked entries can't be diffed against, and large binary works aren't worth diffing, so those are always
+        # kept as keyframes.
+        delta_codec = choose_delta_codec(file_format, len(work))
+        make_keyframe = (previous_head_work.chunked or delta_codec is None or
+                         await count_diffs_since_keyframe(previous_head_work.storage_id) + 1 >= self.keyframe_interval)
+        if make_keyframe:
+            await self.store_file_compressed_async(storage_key, work)
+        else:
+            # The new head upload and the old head download don't depend on each other
+            _, old_work = await asyncio.gather(self.store_file_compressed_async(storage_key, work),
+                                               self.get_file_compressed_async(previous_head_work.location))
+        storage_id = await add_storage_entry(work_id, uploaded_time, updated_time, storage_key, retrieved_from,
+                                             file_format, work_sha1, title, author)
+
+        if make_keyframe:
+            await update_storage_patch(previous_head_work.storage_id, storage_id, True)
+            return
+        # Create diff file to maintain history
+        start = time.perf_counter()
+        diff = await asyncio.to_thread(delta_codec.diff, work, old_work)
+        metrics.delta_seconds.labels(delta_codec.name, "diff").observe(time.perf_counter() - start)
+        await self.store_file_compressed_async(previous_head_work.location, diff)
+        await update_storage_patch(previous_head_work.storage_id, storage_id, False, delta_codec.name)
+
+    async def get_work_by_lookup(self, work_id: int, file_format: str) -> bytes | None:
+        head_work = await get_head_work_storage_data(work_id, file_format)
         if head_work is None:
             return None
-        return self.get_file_compressed(head_work.location)
+        return await self.get_full_work(head_work)
 
-    def get_work(self, storage_id: int) -> tuple[bytes, StorageData]:
-        storage_entry = get_storage_entry(storage_id)
-        if storage_entry is None:
+    async def store_chunks(self, storage_id: int, work: bytes) -> None:
+        """Splits a work into chunks, uploads the ones not already stored, and writes the entry's chunk manifest"""
+        chunks = await split_chunks_async(work)
+        chunk_sha1s = [hashlib.sha1(chunk).hexdigest() for chunk in chunks]
+        existing_chunks = await find_existing_chunks(list(set(chunk_sha1s)))
+        new_chunks = {sha1: chunk for sha1, chunk in zip(chunk_sha1s, chunks) if sha1 not in existing_chunks}
+        await self._bounded_gather([self.store_file_compressed_async(f"chunk_{sha1}", chunk)
+                                    for sha1, chunk in new_chunks.items()])
+        if new_chunks:
+            await add_chunks([(sha1, f"chunk_{sha1}", len(chunk)) for sha1, chunk in new_chunks.items()])
+        await add_work_chunks(storage_id, chunk_sha1s)
+
+    async def get_full_work(self, storage_entry: StorageData) -> bytes:
+        """Gets the contents of an entry that holds a full copy (a head or keyframe), whether chunked or not"""
+        if not storage_entry.chunked:
+            return await self.get_file_compressed_async(storage_entry.location)
+        async with ConnManager():
+            chunk_locations = await get_work_chunk_locations(storage_entry.storage_id)
+        return b"".join(await self.get_files_compressed_async(chunk_locations))
+
+    async def get_work(self, storage_id: int) -> tuple[bytes, StorageData]:
+        storage_chain = await get_patch_chain(storage_id, 100)  # limiting chain length just in case
+        if not storage_chain:
             raise WorkNotFound("The archived work doesn't seem to exist.")
-        storage_patches = []  # list of storage entries to be fetched for patching
-        original_storage_entry = storage_entry
-        for _ in range(100):  # limiting iterations just in case
-            storage_patches.insert(0, storage_entry)
-            if storage_entry.patch_of is None:
-                break
-            storage_entry = get_storage_entry(storage_entry.patch_of)
-        else:
+        full_entry = storage_chain[-1]
+        if full_entry.patch_of is not None and not full_entry.keyframe:
             raise TooManyIterations("Too many iterations to reach head work. Is there an infinite loop?")
 
-        master_file = self.get_file_compressed(storage_patches.pop(0).location)
-        for storage_patch in storage_patches:
-            diff_bytes = self.get_file_compressed(storage_patch.location)
-            master_file = bsdiff4.patch(master_file, diff_bytes)
+        # Start from the closest cached version along the chain, if there is one
+        cached = await self.version_cache.get_first([entry.storage_id for entry in storage_chain])
+        if cached is None:
+            patch_entries = list(reversed(storage_chain[:-1]))
+            master_file, diffs = await asyncio.gather(
+                self.get_full_work(full_entry),
+                self.get_files_compressed_async([entry.location for entry in patch_entries]))
+            await self.version_cache.put(full_entry.storage_id, master_file)
+        else:
+            cached_index, master_file = cached
+            patch_entries = list(reversed(storage_chain[:cached_index]))
+            diffs = await self.get_files_compressed_async([entry.location for entry in patch_entries])
+
+        # Patches are applied from the full copy back towards the requested version. Every intermediate version is
+        # cached along the way, so neighbouring versions are cheap to serve afterward.
+        metrics.patch_chain_length.observe(len(patch_entries))
+        for storage_entry, diff_bytes in zip(patch_entries, diffs):
+            delta_codec = delta_codecs[storage_entry.delta_codec]
+            start = time.perf_counter()
+            master_file = await asyncio.to_thread(delta_codec.patch, master_file, diff_bytes)
+            metrics.delta_seconds.labels(delta_codec.name, "patch").observe(time.perf_counter() - start)
+            await self.version_cache.put(storage_entry.storage_id, master_file)
 
-        return master_file, original_storage_entry
+        return master_file, storage_chain[0]
 
-    def rewrite_html_sources(self, work: bytes, supporting_objects: List[SupportingObject | SupportingCachedObject],
-                             work_id: int) -> bytes:
-        work_text = UnicodeDammit(work, is_html=True).unicode_markup
+    async def rewrite_html_sources(self, work: bytes,
+                                   supporting_objects: List[SupportingObject | SupportingCachedObject],
+                                   work_id: int) -> bytes:
+        # Every url is located up front, so a work that's missing one is rejected before anything is stored
+        try:
+            rewriter = await asyncio.to_thread(SourceRewriter, work, [obj.url for obj in supporting_objects])
+        except SourceNotFound as e:
+            raise ValueError(f"Supporting object URL '{e.url}' not found in work {work_id}") from e
 
-        # Validate that all supporting object urls are actually present in work
-        for supporting_object in supporting_objects:
-            if supporting_object.url not in work_text and html.escape(supporting_object.url) not in work_text:
-                raise ValueError(f"Supporting object URL '{supporting_object.url}' not found in work {work_id}")
+        # Registering the objects takes the same few round trips however many there are: one lookup, concurrent
+        # uploads of the missing ones, then one insert into each table.
+        new_objects = {obj.sha1: obj for obj in supporting_objects if isinstance(obj, SupportingObject)}
+        object_ids = {}
+        if new_objects:
+            existing_sha1s = await find_existing_objects(list(new_objects))
+            uploads = {f"obj_{sha1}": obj.file for sha1, obj in new_objects.items() if sha1 not in existing_sha1s}
+            await self.store_fileobjs_async(uploads)
+            if uploads:
+                await add_object_entries([(key.removeprefix("obj_"), key) for key in uploads])
+            object_ids = await add_object_index_entries(
+                [{"request_url": obj.url, "sha1": obj.sha1, "etag": obj.etag, "mimetype": obj.mimetype}
+                 for obj in supporting_objects if isinstance(obj, SupportingObject)], work_id)
 
-        # Upload supporting objects, if not already uploaded.
+        replacements = []
         for supporting_object in supporting_objects:
             if isinstance(supporting_object, SupportingCachedObject):
-                work_text = work_text.replace(supporting_object.url, f"/objects/{supporting_object.object_id}", 1)
-                continue
-
-            sha1 = supporting_object.data_sha1()
-            object_index_id: int
-            if not object_exists(sha1):
-                file_key = f"obj_{sha1}"
-                self.store_file(file_key, supporting_object.data)
-                create_object_entry(sha1, file_key)
-                object_index_id = create_object_index_entry(sha1, supporting_object.url, supporting_object.etag,
-                                                            work_id, supporting_object.mimetype)
+                object_index_id = supporting_object.object_id
             else:
-                object_index_id = find_object_index_entry(sha1, supporting_object.url, supporting_object.etag, work_id)
-                if object_index_id is None:
-                    object_index_id = create_object_index_entry(sha1, supporting_object.url, supporting_object.etag,
-                                                                work_id, supporting_object.mimetype)
-            if supporting_object.url in work_text:
-                work_text = work_text.replace(supporting_object.url, f"/objects/{object_index_id}", 1)
-            else:
-                escaped_url = html.escape(supporting_object.url)
-                if escaped_url in work_text:
-                    work_text = work_text.replace(escaped_url, f"/objects/{object_index_id}", 1)
-                else:
-                    raise ValueError(f"Supporting object URL '{supporting_object.url}' not found despite passing check in {work_id}")
-
-        return work_text.encode('utf-8')
+                object_index_id = object_ids[(supporting_object.url, supporting_object.sha1, supporting_object.etag)]
+            replacements.append(f"/objects/{object_index_id}")
+        return await asyncio.to_thread(rewriter.rewrite, replacements)
 
 
 class TooManyIterations(Exception):
@@ -0,0 +1,134 @@
+import asyncio
+import os
+from typing import AsyncIterator, BinaryIO, Dict
+
+from . import StorageManager
+from .disk_cache import DiskCache
+
+
+class CachingManager(StorageManager):
+    """
+    Wraps another storage manager with a size-bounded LRU cache on local disk. Reads fill the cache, writes warm it
+    and deletes invalidate it. The cache directory can be shared by every worker process on a host.
+
+    Only content addressed keys (objects and chunks) are cached, as those never change once written. Work heads are
+    overwritten with a diff when the next version arrives, which another host's cache would never hear about.
+    """
+    cached_prefixes = ("obj_", "chunk_")
+
+    def __init__(self, backend: StorageManager, directory: str, max_bytes: int, max_file_bytes: int):
+        self.backend = backend
+        self.executor = backend.executor
+        self.cache = DiskCache(directory, max_bytes)
+        # Larger files aren't cached, so one big file can't flush out everything else
+        self.max_file_bytes = max_file_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls, backend: StorageManager) -> "CachingManager":
+        return cls(backend, os.environ["STORAGE_CACHE_DIR"],
+                   int(os.environ.get("STORAGE_CACHE_BYTES", 10 * 1024 ** 3)),
+                   int(os.environ.get("STORAGE_CACHE_MAX_FILE_BYTES", 32 * 1024 ** 2)))
+
+    def _cacheable(self, key: str) -> bool:
+        return key.startswith(self.cached_prefixes)
+
+    def _cache_put(self, key: str, data: bytes) -> None:
+        if not self._cacheable(key):
+            return
+        if len(data) <= self.max_file_bytes:
+            self.cache.put(key, data)
+        else:
+            self.cache.delete(key)
+
+    def store_file(self, key: str, data: bytes) -> None:
+        self.backend.store_file(key, data)
+        self._cache_put(key, data)
+
+    def store_fileobj(self, key: str, file: BinaryIO) -> None:
+        if not self._cacheable(key):
+            self.backend.store_fileobj(key, file)
+            return
+        # Backends may close the file (boto3 does), so what's cached is read before handing it over
+        start = file.tell()
+        file.seek(0, os.SEEK_END)
+        data = None
+        if file.tell() - start <= self.max_file_bytes:
+            file.seek(start)
+            data = file.read()
+        file.seek(start)
+        self.backend.store_fileobj(key, file)
+        if data is not None:
+            self.cache.put(key, data)
+        else:
+            self.cache.delete(key)
+
+    def delete_file(self, key: str) -> None:
+        self.backend.delete_file(key)
+        self.cache.delete(key)
+
+    def get_file(self, key: str) -> bytes:
+        if not self._cacheable(key):
+            return self.backend.get_file(key)
+        data = self.cache.get(key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = self.backend.get_file(key)
+        self._cache_put(key, data)
+        return data
+
+    def get_file_size(self, key: str) -> int:
+        return self.backend.get_file_size(key)
+
+    def local_path(self, key: str) -> str | None:
+        return self.backend.local_path(key)
+
+    async def store_file_async(self, key: str, data: bytes) -> None:
+        await self.backend.store_file_async(key, data)
+        await asyncio.to_thread(self._cache_put, key, data)
+
+    async def delete_file_async(self, key: str) -> None:
+        await self.backend.delete_file_async(key)
+        await asyncio.to_thread(self.cache.delete, key)
+
+    async def get_file_async(self, key: str) -> bytes:
+        if not self._cacheable(key):
+            return await self.backend.get_file_async(key)
+        data = await asyncio.to_thread(self.cache.get, key)
+        if data is not None:
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = await self.backend.get_file_async(key)
+        await asyncio.to_thread(self._cache_put, key, data)
+        return data
+
+    async def stream_file_async(self, key: str, start: int = 0, stop: int | None = None,
+                                chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        if not self._cacheable(key):
+            async for chunk in self.backend.stream_file_async(key, start, stop, chunk_size):
+                yield chunk
+            return
+        data = await asyncio.to_thread(self.cache.get, key)
+        if data is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if start != 0 or stop is not None:
+                # Ranges of uncached files are streamed from the backend without filling the cache
+                async for chunk in self.backend.stream_file_async(key, start, stop, chunk_size):
+                    yield chunk
+                return
+            data = await self.backend.get_file_async(key)
+            await asyncio.to_thread(self._cache_put, key, data)
+        view = memoryview(data)[start:stop]
+        for offset in range(0, len(view), chunk_size):
+            yield bytes(view[offset:offset + chunk_size])
+
+    def stats(self) -> Dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.cache.evictions, "max_bytes": self.cache.max_bytes}
@@ -0,0 +1,83 @@
+"""
+Content-defined chunking (a FastCDC style gear hash), used to split works into chunks that can be deduplicated. Since
+chunk boundaries depend on the surrounding bytes rather than on offsets, an edit only changes the chunks around it.
+
+The hash runs a byte at a time in pure Python, about 0.25 s per MB, and holds the GIL throughout, so async code runs it
+in a separate process with split_chunks_async rather than in a thread.
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+# Fixed seed, so chunk boundaries stay the same across processes and releases
+_gear_random = random.Random(0xA03)
+_gear = [_gear_random.getrandbits(32) for _ in range(256)]
+
+min_chunk_size = 2 * 1024
+avg_chunk_size = 8 * 1024
+max_chunk_size = 64 * 1024
+
+
+def _mask(bits: int) -> int:
+    # Uses the top bits of the 32 bit hash, which depend on the most bytes
+    return ((1 << bits) - 1) << (32 - bits)
+
+
+# Normalized chunking: a harder mask before the average size and an easier one after it keeps sizes close to average
+_mask_hard = _mask(avg_chunk_size.bit_length())
+_mask_easy = _mask(avg_chunk_size.bit_length() - 2)
+
+
+def _find_boundary(data: bytes, start: int, end: int) -> int:
+    if end - start <= min_chunk_size:
+        return end
+    gear = _gear
+    fingerprint = 0
+    normal_end = min(start + avg_chunk_size, end)
+    max_end = min(start + max_chunk_size, end)
+    position = start + min_chunk_size
+    for position in range(position, normal_end):
+        fingerprint = ((fingerprint << 1) + gear[data[position]]) & 0xFFFFFFFF
+        if not fingerprint & _mask_hard:
+            return position + 1
+    for position in range(normal_end, max_end):
+        fingerprint = ((fingerprint << 1) + gear[data[position]]) & 0xFFFFFFFF
+        if not fingerprint & _mask_easy:
+            return position + 1
+    return max_end
+
+
+def chunk_boundaries(data: bytes) -> List[int]:
+    """Returns the end offset of every chunk"""
+    boundaries = []
+    start = 0
+    while start < len(data):
+        start = _find_boundary(data, start, len(data))
+        boundaries.append(start)
+    return boundaries
+
+
+def split_chunks(data: bytes) -> List[bytes]:
+    chunks = []
+    start = 0
+    for end in chunk_boundaries(data):
+        chunks.append(data[start:end])
+        start = end
+    return chunks
+
+
+chunking_processes = int(os.environ.get("CHUNKING_PROCESSES", 1))
+_process_pool: ProcessPoolExecutor | None = None
+
+
+async def split_chunks_async(data: bytes) -> List[bytes]:
+    """split_chunks, run in a separate process so it doesn't stall the event loop"""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(chunking_processes, mp_context=multiprocessing.get_context("spawn"))
+    # Only the offsets come back, which is far less to send between processes than the chunks themselves
+    boundaries = await asyncio.get_running_loop().run_in_executor(_process_pool, chunk_boundaries, data)
+    return [data[start:end] for start, end in zip([0] + boundaries, boundaries)]
@@ -0,0 +1,128 @@
+"""
+Compression for stored blobs. Blobs are self-describing, zstd frames start with their magic number (and carry the id of
+the dictionary they were made with) and anything else is zlib, so blobs written under any codec stay readable.
+"""
+import os
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, List
+import zstandard
+
+
+class UnknownDictionary(Exception):
+    pass
+
+
+class CompressionCodec(ABC):
+    name: str
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        pass
+
+
+class ZlibCodec(CompressionCodec):
+    name = "zlib"
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+zstd_magic = b"\x28\xb5\x2f\xfd"
+
+
+class ZstdCodec(CompressionCodec):
+    name = "zstd"
+
+    def __init__(self, level: int, directory: str | None, dict_id: int | None = None):
+        """
+        Compresses with dictionary dict_id if given. Dictionaries (saved as <dict id>.zdict in directory) are loaded
+        when a blob made with one is first read, so ones trained while running can be read without a restart.
+        """
+        self.level = level
+        self.directory = directory
+        self.dictionaries: Dict[int, zstandard.ZstdCompressionDict] = {}
+        self.dictionary = self._load_dictionary(dict_id) if dict_id is not None else None
+        # zstd contexts can't be used by two threads at once, so each thread gets its own
+        self._local = threading.local()
+
+    def _load_dictionary(self, dict_id: int) -> zstandard.ZstdCompressionDict:
+        if dict_id not in self.dictionaries:
+            path = os.path.join(self.directory or "", f"{dict_id}.zdict")
+            if not self.directory or not os.path.isfile(path):
+                raise UnknownDictionary(f"zstd dictionary {dict_id} isn't in ZSTD_DICT_DIR ({self.directory})")
+            with open(path, "rb") as file:
+                self.dictionaries[dict_id] = zstandard.ZstdCompressionDict(file.read())
+        return self.dictionaries[dict_id]
+
+    def _compressor(self) -> zstandard.ZstdCompressor:
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary)
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, dict_id: int) -> zstandard.ZstdDecompressor:
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        if dict_id not in decompressors:
+            dictionary = self._load_dictionary(dict_id) if dict_id else None
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressors[dict_id]
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        return self._decompressor(dict_id).decompress(data)
+
+
+zstd_dict_dir = os.environ.get("ZSTD_DICT_DIR")
+compression_codecs: Dict[str, CompressionCodec] = {
+    "zlib": ZlibCodec(),
+    # New blobs only use a dictionary when ZSTD_DICT_ID names one, so every worker writes with the same one
+    "zstd": ZstdCodec(int(os.environ.get("ZSTD_LEVEL", 9)), zstd_dict_dir,
+                      int(os.environ["ZSTD_DICT_ID"]) if os.environ.get("ZSTD_DICT_ID") else None),
+}
+# Codec new blobs are written with
+compression_codec = compression_codecs[os.environ.get("COMPRESSION_CODEC", "zlib")]
+
+
+def blob_codec(data: bytes) -> CompressionCodec:
+    if data[:4] == zstd_magic:
+        return compression_codecs["zstd"]
+    return compression_codecs["zlib"]
+
+
+def needs_recompression(data: bytes) -> bool:
+    """Checks if a blob was written with anything other than the current codec and dictionary"""
+    codec = blob_codec(data)
+    if codec is not compression_codec:
+        return True
+    if isinstance(codec, ZstdCodec):
+        dict_id = zstandard.get_frame_parameters(data).dict_id
+        return dict_id != (codec.dictionary.dict_id() if codec.dictionary is not None else 0)
+    return False
+
+
+def compress(data: bytes) -> bytes:
+    return compression_codec.compress(data)
+
+
+def decompress(data: bytes) -> bytes:
+    return blob_codec(data).decompress(data)
+
+
+def train_dictionary(samples: List[bytes], dict_size: int, level: int | None = None) -> zstandard.ZstdCompressionDict:
+    level = compression_codecs["zstd"].level if level is None else level
+    return zstandard.train_dictionary(dict_size, samples, level=level)
@@ -0,0 +1,157 @@
+"""
+Delta codecs used to store older versions of a work as a diff against the version after it. The codec used is recorded
+per storage entry, so codecs can be added or the selection changed without touching what's already stored.
+"""
+import difflib
+import hashlib
+import os
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, List
+import bsdiff4
+
+from .chunking import split_chunks
+
+
+class DeltaCodec(ABC):
+    name: str
+
+    @abstractmethod
+    def diff(self, source: bytes, target: bytes) -> bytes:
+        """Creates a delta that rebuilds target from source"""
+
+    @abstractmethod
+    def patch(self, source: bytes, delta: bytes) -> bytes:
+        pass
+
+
+class BsdiffCodec(DeltaCodec):
+    """Smallest deltas, but memory hungry and superlinear on large inputs"""
+    name = "bsdiff"
+
+    def diff(self, source: bytes, target: bytes) -> bytes:
+        return bsdiff4.diff(source, target)
+
+    def patch(self, source: bytes, delta: bytes) -> bytes:
+        return bsdiff4.patch(source, delta)
+
+
+# Copy/add deltas are a list of instructions: copy a range out of the source, or add literal bytes.
+_copy_op = struct.Struct("<cQQ")  # b"c", source offset, length
+_add_op = struct.Struct("<cQ")  # b"a", length, followed by the bytes
+
+
+def _encode_copy_add(instructions: List[tuple[int, int] | bytes]) -> bytes:
+    encoded = []
+    for instruction in instructions:
+        if isinstance(instruction, bytes):
+            encoded.append(_add_op.pack(b"a", len(instruction)))
+            encoded.append(instruction)
+        else:
+            encoded.append(_copy_op.pack(b"c", *instruction))
+    return b"".join(encoded)
+
+
+def _append_copy(instructions: List[tuple[int, int] | bytes], offset: int, length: int) -> None:
+    # Copies of neighbouring source ranges are merged into one
+    if instructions and isinstance(instructions[-1], tuple) and sum(instructions[-1]) == offset:
+        instructions[-1] = (instructions[-1][0], instructions[-1][1] + length)
+    else:
+        instructions.append((offset, length))
+
+
+def _apply_copy_add(source: bytes, delta: bytes) -> bytes:
+    output = []
+    position = 0
+    while position < len(delta):
+        if delta[position:position + 1] == b"c":
+            _, offset, length = _copy_op.unpack_from(delta, position)
+            output.append(source[offset:offset + length])
+            position += _copy_op.size
+        else:
+            _, length = _add_op.unpack_from(delta, position)
+            position += _add_op.size
+            output.append(delta[position:position + length])
+            position += length
+    return b"".join(output)
+
+
+class ChunkCopyCodec(DeltaCodec):
+    """
+    An xdelta style copy/add codec that matches content-defined chunks. Linear time and memory, at the cost of
+    coarser matches than bsdiff. Works on any format.
+
+    It's never chosen on its own. Force it with DELTA_CODEC=chunkcopy when large works are in formats that keep most
+    of their bytes in place between versions (ex: uncompressed ones), where linediff doesn't apply and bsdiff is too
+    slow. It stays registered regardless, so entries stored with it can still be read.
+    """
+    name = "chunkcopy"
+
+    def diff(self, source: bytes, target: bytes) -> bytes:
+        source_chunks = {}
+        offset = 0
+        for chunk in split_chunks(source):
+            source_chunks.setdefault(hashlib.sha1(chunk).digest(), (offset, len(chunk)))
+            offset += len(chunk)
+
+        instructions = []
+        for chunk in split_chunks(target):
+            match = source_chunks.get(hashlib.sha1(chunk).digest())
+            if match is None:
+                instructions.append(chunk)
+            else:
+                _append_copy(instructions, *match)
+        return _encode_copy_add(instructions)
+
+    def patch(self, source: bytes, delta: bytes) -> bytes:
+        return _apply_copy_add(source, delta)
+
+
+class LineDiffCodec(DeltaCodec):
+    """
+    Diffs line by line, which lines up with paragraphs in html and txt works. Much faster than bsdiff on large text,
+    with deltas close in size since edits to works are mostly whole paragraphs.
+    """
+    name = "linediff"
+
+    def diff(self, source: bytes, target: bytes) -> bytes:
+        source_lines = source.splitlines(keepends=True)
+        target_lines = target.splitlines(keepends=True)
+        line_offsets = [0]
+        for line in source_lines:
+            line_offsets.append(line_offsets[-1] + len(line))
+
+        instructions = []
+        matcher = difflib.SequenceMatcher(None, source_lines, target_lines)
+        for tag, source_start, source_end, target_start, target_end in matcher.get_opcodes():
+            if tag == "equal":
+                _append_copy(instructions, line_offsets[source_start],
+                             line_offsets[source_end] - line_offsets[source_start])
+            elif tag in ("replace", "insert"):
+                instructions.append(b"".join(target_lines[target_start:target_end]))
+        return _encode_copy_add(instructions)
+
+    def patch(self, source: bytes, delta: bytes) -> bytes:
+        return _apply_copy_add(source, delta)
+
+
+delta_codecs: Dict[str, DeltaCodec] = {codec.name: codec for codec in (BsdiffCodec(), ChunkCopyCodec(), LineDiffCodec())}
+
+# Works up to this size are diffed with bsdiff, which gives the smallest deltas while it's still cheap
+bsdiff_max_size = int(os.environ.get("DELTA_BSDIFF_MAX_BYTES", 1024 * 1024))
+forced_codec = os.environ.get("DELTA_CODEC")
+
+
+def choose_delta_codec(file_format: str, size: int) -> DeltaCodec | None:
+    """
+    Picks the codec to diff a version with, or None if it should be kept whole instead. Larger binary formats (pdf,
+    epub and the like) are compressed containers, so even small edits change most of the bytes. Diffing them costs
+    seconds of CPU under the GIL for deltas that save little, so they're kept whole.
+    """
+    if forced_codec:
+        return delta_codecs[forced_codec]
+    if size <= bsdiff_max_size:
+        return delta_codecs["bsdiff"]
+    if file_format in ("html", "txt"):
+        return delta_codecs["linediff"]
+    return None
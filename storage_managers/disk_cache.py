@@ -0,0 +1,94 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+
+
+class DiskCache:
+    """
+    A size-bounded LRU of files kept in a directory. Safe to share between processes: files are written to a temp file
+    and renamed into place, reads bump the file's mtime, and only one process prunes at a time.
+    """
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._written_since_prune = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        # Walking the directory is expensive, so it's only done once a tenth of the budget has been written
+        self._written_since_prune += len(data)
+        if self._written_since_prune > self.max_bytes // 10:
+            self._written_since_prune = 0
+            self.prune()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self) -> None:
+        """Deletes the least recently used files until the cache is back under 90% of its budget"""
+        with open(os.path.join(self.directory, ".prune_lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # Another process is already pruning
+                return
+
+            files = []
+            total_size = 0
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    if entry.name.startswith(".tmp"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            if total_size <= self.max_bytes:
+                return
+            files.sort()
+            target_size = self.max_bytes * 9 // 10
+            for _, size, path in files:
+                if total_size <= target_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                self.evictions += 1
@@ -0,0 +1,77 @@
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO
+from urllib.parse import quote
+
+from . import StorageManager
+
+
+class FilesystemManager(StorageManager):
+    """
+    Keeps files in a local directory, sharded into two levels of subdirectories by the hash of their key so no single
+    directory grows too large. Writes go to a temp file that's renamed into place, so readers never see a partial file.
+    """
+    def __init__(self):
+        self.directory = os.environ["FILESYSTEM_STORAGE_DIR"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=int(os.environ.get("FILESYSTEM_MAX_THREADS", 16)),
+                                           thread_name_prefix="filesystem")
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest[2:4], quote(key, safe=""))
+
+    def _write(self, key: str, write) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def store_file(self, key: str, data: bytes) -> None:
+        self._write(key, lambda f: f.write(data))
+
+    def store_fileobj(self, key: str, file: BinaryIO) -> None:
+        self._write(key, lambda f: shutil.copyfileobj(file, f, 1024 * 1024))
+
+    def delete_file(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get_file(self, key: str) -> bytes:
+        with open(self._path(key), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:  # Empty files can't be mapped
+                return b""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+
+    def get_file_size(self, key: str) -> int:
+        return os.stat(self._path(key)).st_size
+
+    def local_path(self, key: str) -> str | None:
+        return self._path(key)
+
+    async def stream_file_async(self, key: str, start: int = 0, stop: int | None = None,
+                                chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        with open(self._path(key), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            stop = size if stop is None else min(stop, size)
+            if start >= stop:
+                return
+            # Only the pages of the requested range are ever read in from disk
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(start, stop, chunk_size):
+                    yield await self.run_blocking(mapped.__getitem__, slice(offset, min(offset + chunk_size, stop)))
@@ -0,0 +1,61 @@
+"""
+Rewrites the urls of supporting objects in a work to point at their stored copies, in a single pass over the document.
+"""
+import html
+import re
+from typing import Dict, List
+from bs4.dammit import UnicodeDammit
+
+
+class SourceNotFound(ValueError):
+    def __init__(self, url: str):
+        super().__init__(f"Supporting object URL '{url}' not found")
+        self.url = url
+
+
+def decode_html(work: bytes) -> str:
+    """Decodes a work, assuming utf-8 (as every AO3 download is) before falling back to encoding detection"""
+    try:
+        return work.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return UnicodeDammit(work, is_html=True).unicode_markup
+
+
+class SourceRewriter:
+    """
+    Finds where each url appears in a work, then rewrites them. Each url replaces one occurrence, in order, so a url
+    listed twice replaces its first two occurrences. The url as written is preferred over its html escaped form.
+    Locating happens on construction, so missing urls are found before anything else is done with the objects.
+    """
+    def __init__(self, work: bytes, urls: List[str]):
+        self.text = decode_html(work)
+
+        forms = {url: [url, html.escape(url)] for url in urls}
+        patterns = sorted({form for url_forms in forms.values() for form in url_forms}, key=len, reverse=True)
+        occurrences: Dict[str, List[tuple[int, int]]] = {pattern: [] for pattern in patterns}
+        if patterns:
+            # Longest patterns are tried first, so a url that prefixes another can't match inside it
+            for match in re.finditer("|".join(map(re.escape, patterns)), self.text):
+                occurrences[match.group()].append(match.span())
+
+        next_occurrence = {pattern: 0 for pattern in patterns}
+        self.spans: List[tuple[int, int]] = []
+        for url in urls:
+            for form in forms[url]:
+                if next_occurrence[form] < len(occurrences[form]):
+                    self.spans.append(occurrences[form][next_occurrence[form]])
+                    next_occurrence[form] += 1
+                    break
+            else:
+                raise SourceNotFound(url)
+
+    def rewrite(self, replacements: List[str]) -> bytes:
+        """Replaces each url's occurrence with the replacement at the same index, returning the work as utf-8"""
+        parts = []
+        position = 0
+        for (start, stop), replacement in sorted(zip(self.spans, replacements)):
+            parts.append(self.text[position:start])
+            parts.append(replacement)
+            position = stop
+        parts.append(self.text[position:])
+        return "".join(parts).encode("utf-8")
@@ -0,0 +1,27 @@
+from typing import Dict
+
+from . import StorageManager
+
+
+class MemoryManager(StorageManager):
+    """Keeps every file in a dict. Meant as a stand-in for tests and local development, not for production use."""
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+
+    def store_file(self, key: str, data: bytes) -> None:
+        self.files[key] = bytes(data)
+
+    def delete_file(self, key: str) -> None:
+        self.files.pop(key, None)
+
+    def get_file(self, key: str) -> bytes:
+        return self.files[key]
+
+    async def store_file_async(self, key: str, data: bytes) -> None:
+        self.store_file(key, data)
+
+    async def delete_file_async(self, key: str) -> None:
+        self.delete_file(key)
+
+    async def get_file_async(self, key: str) -> bytes:
+        return self.get_file(key)
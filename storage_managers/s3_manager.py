@@ -1,7 +1,12 @@
+import functools
 import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, BinaryIO
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
+import metrics
 
 from . import StorageManager
 
@@ -13,22 +18,63 @@ class S3Manager(StorageManager):
         region = os.environ["S3_REGION_NAME"]
         endpoint_url = os.environ["S3_ENDPOINT"]
         self.bucket = os.environ["S3_BUCKET"]
+        max_connections = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 32))
 
         session = boto3.session.Session()
         self.client = session.client('s3',
-                                     config=botocore.config.Config(s3={'addressing_style': 'virtual'}),
+                                     config=botocore.config.Config(s3={'addressing_style': 'virtual'},
+                                                                   max_pool_connections=max_connections),
                                      region_name=region,
                                      endpoint_url=endpoint_url,
                                      aws_access_key_id=public_key,
                                      aws_secret_access_key=private_key)
+        # boto3 clients are thread safe, so every async call shares the client (and its connection pool) through a
+        # thread pool sized to match it.
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="s3")
+        # Uploads from file objects switch to multipart above this size, streaming one part at a time
+        multipart_size = int(os.environ.get("S3_MULTIPART_BYTES", 8 * 1024 ** 2))
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_size, multipart_chunksize=multipart_size,
+                                              use_threads=False)
 
     def store_file(self, key: str, data: bytes) -> None:
-        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        with metrics.storage_seconds.labels("put").time():
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+        metrics.storage_bytes.labels("put").inc(len(data))
+
+    def store_fileobj(self, key: str, file: BinaryIO) -> None:
+        # boto3 closes the file once it's uploaded, so its size has to be taken first
+        start = file.tell()
+        size = file.seek(0, io.SEEK_END) - start
+        file.seek(start)
+        with metrics.storage_seconds.labels("put").time():
+            self.client.upload_fileobj(file, self.bucket, key, Config=self.transfer_config)
+        metrics.storage_bytes.labels("put").inc(size)
 
     def delete_file(self, key: str) -> None:
-        self.client.delete_object(Bucket=self.bucket, Key=key)
+        with metrics.storage_seconds.labels("delete").time():
+            self.client.delete_object(Bucket=self.bucket, Key=key)
 
     def get_file(self, key: str) -> bytes:
         bytes_buffer = io.BytesIO()
-        self.client.download_fileobj(Bucket=self.bucket, Key=key, Fileobj=bytes_buffer)
+        with metrics.storage_seconds.labels("get").time():
+            self.client.download_fileobj(Bucket=self.bucket, Key=key, Fileobj=bytes_buffer)
+        metrics.storage_bytes.labels("get").inc(bytes_buffer.tell())
         return bytes_buffer.getvalue()
+
+    def get_file_size(self, key: str) -> int:
+        with metrics.storage_seconds.labels("head").time():
+            return self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+
+    async def stream_file_async(self, key: str, start: int = 0, stop: int | None = None,
+                                chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        file_range = f"bytes={start}-{'' if stop is None else stop - 1}"
+        with metrics.storage_seconds.labels("get_range").time():
+            response = await self.run_blocking(functools.partial(self.client.get_object, Bucket=self.bucket, Key=key,
+                                                                 Range=file_range))
+        body = response["Body"]
+        try:
+            while chunk := await self.run_blocking(body.read, chunk_size):
+                metrics.storage_bytes.labels("get").inc(len(chunk))
+                yield chunk
+        finally:
+            body.close()
@@ -0,0 +1,84 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Dict, List
+
+from .disk_cache import DiskCache
+
+
+class VersionCache:
+    """
+    Caches reconstructed work versions by storage_id. Since a stored version never changes, entries never need to be
+    invalidated. Entries are kept in an in-process LRU bounded by total bytes, with an optional on-disk second tier
+    that's shared between worker processes.
+    """
+    def __init__(self, max_bytes: int, disk_directory: str = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[int, bytes] = OrderedDict()
+        self.disk = DiskCache(disk_directory, disk_max_bytes) if disk_directory else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls) -> "VersionCache":
+        return cls(int(os.environ.get("VERSION_CACHE_BYTES", 256 * 1024 ** 2)),
+                   os.environ.get("VERSION_CACHE_DIR"),
+                   int(os.environ.get("VERSION_CACHE_DISK_BYTES", 2 * 1024 ** 3)))
+
+    def _put_memory(self, storage_id: int, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if storage_id in self.entries:
+            self.size -= len(self.entries.pop(storage_id))
+        self.entries[storage_id] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def _get_disk_first(self, storage_ids: List[int]) -> tuple[int, bytes] | None:
+        for index, storage_id in enumerate(storage_ids):
+            data = self.disk.get(str(storage_id))
+            if data is not None:
+                return index, data
+        return None
+
+    async def get_first(self, storage_ids: List[int]) -> tuple[int, bytes] | None:
+        """
+        Returns the index and contents of the first of storage_ids that's cached, or None. Counts as one hit or miss
+        however many ids are checked, and the disk tier is only checked (in one go) if none are in memory.
+        """
+        for index, storage_id in enumerate(storage_ids):
+            data = self.entries.get(storage_id)
+            if data is not None:
+                self.entries.move_to_end(storage_id)
+                self.hits += 1
+                return index, data
+
+        if self.disk is not None and storage_ids:
+            found = await asyncio.to_thread(self._get_disk_first, storage_ids)
+            if found is not None:
+                self.disk_hits += 1
+                self._put_memory(storage_ids[found[0]], found[1])
+                return found
+
+        self.misses += 1
+        return None
+
+    async def get(self, storage_id: int) -> bytes | None:
+        found = await self.get_first([storage_id])
+        return found[1] if found is not None else None
+
+    async def put(self, storage_id: int, data: bytes) -> None:
+        self._put_memory(storage_id, data)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, str(storage_id), data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions,
+                "disk_evictions": self.disk.evictions if self.disk is not None else 0,
+                "entries": len(self.entries), "bytes": self.size, "max_bytes": self.max_bytes}
@@ -0,0 +1,109 @@
+"""
+Helpers for serving immutable content: strong ETags, conditional GETs, single byte ranges and chunked streaming
+"""
+from typing import AsyncIterator, Callable
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from storage_managers import StorageManager
+
+chunk_size = 256 * 1024
+immutable_cache_control = "max-age=31536000, immutable"
+
+
+def make_etag(sha1: str) -> str:
+    return f'"{sha1}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Checks a request's If-None-Match header against an etag"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(request: Request, etag: str, size: int) -> tuple[int, int] | None:
+    """
+    Returns the (start, stop) byte offsets requested by the Range header, or None if the whole body should be sent.
+    Only single ranges are honoured; anything else gets the whole body, which the spec allows.
+    """
+    range_header = request.headers.get("range")
+    if range_header is None or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range.strip() != etag:
+        return None
+
+    start_str, _, end_str = range_header.removeprefix("bytes=").strip().partition("-")
+    try:
+        if start_str == "":  # Suffix range, ex: bytes=-500 for the last 500 bytes
+            suffix_length = int(end_str)
+            if suffix_length == 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(size - suffix_length, 0), size
+        start = int(start_str)
+        end = int(end_str) if end_str else None
+    except ValueError:
+        return None
+    if end is not None and end < start:  # The last byte is before the first, an invalid range, which is ignored
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, size if end is None else min(end + 1, size)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": immutable_cache_control})
+
+
+def _range_response(request: Request, etag: str, size: int, media_type: str,
+                    stream: Callable[[int, int], AsyncIterator[bytes]]) -> Response:
+    headers = {"ETag": etag, "Cache-Control": immutable_cache_control, "Accept-Ranges": "bytes"}
+    try:
+        byte_range = parse_range(request, etag, size)
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    if byte_range is None:
+        return StreamingResponse(stream(0, size), media_type=media_type,
+                                 headers={**headers, "Content-Length": str(size)})
+    start, stop = byte_range
+    return StreamingResponse(stream(start, stop), status_code=206, media_type=media_type,
+                             headers={**headers, "Content-Length": str(stop - start),
+                                      "Content-Range": f"bytes {start}-{stop - 1}/{size}"})
+
+
+def bytes_response(request: Request, data: bytes, media_type: str, etag: str) -> Response:
+    """Serves bytes that are already in memory, in chunks, honouring Range"""
+    async def stream(start: int, stop: int):
+        view = memoryview(data)
+        for offset in range(start, stop, chunk_size):
+            yield bytes(view[offset:min(offset + chunk_size, stop)])
+
+    return _range_response(request, etag, len(data), media_type, stream)
+
+
+async def storage_response(request: Request, storage: StorageManager, key: str, media_type: str,
+                           etag: str) -> Response:
+    """Streams a file straight out of storage, honouring Range"""
+    headers = {"ETag": etag, "Cache-Control": immutable_cache_control, "Accept-Ranges": "bytes"}
+    local_path = storage.local_path(key)
+    if local_path is not None and "range" not in request.headers:
+        # Files on local disk are sent by the server directly where it supports it, and never pass through Python
+        return FileResponse(local_path, media_type=media_type, headers=headers)
+
+    # The size is only needed to resolve a Range, so plain requests skip looking it up
+    if "range" not in request.headers:
+        return StreamingResponse(storage.stream_file_async(key, 0, None, chunk_size), media_type=media_type,
+                                 headers=headers)
+
+    def stream(start: int, stop: int):
+        return storage.stream_file_async(key, start, stop, chunk_size)
+
+    return _range_response(request, etag, await storage.get_file_size_async(key), media_type, stream)
@@ -0,0 +1,12 @@
+"""
+Lets tests import the app's modules. Importing db needs the connection settings, but doesn't connect, so placeholders do
+for tests that don't touch the database.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name, value in (("POSTGRESQL_DATABASE", "ao3"), ("POSTGRESQL_HOST", "localhost"), ("POSTGRESQL_USER", "postgres"),
+                    ("POSTGRESQL_PASSWORD", ""), ("POSTGRESQL_PORT", "5432")):
+    os.environ.setdefault(name, value)
@@ -0,0 +1,16 @@
+from archived_works import WorkIdBitmap
+
+
+def test_holds_the_added_ids():
+    bitmap = WorkIdBitmap([0, 7, 8, 1000])
+    assert [work_id for work_id in range(1100) if work_id in bitmap] == [0, 7, 8, 1000]
+    assert 10 ** 9 not in bitmap
+
+
+def test_ignores_negative_ids():
+    bitmap = WorkIdBitmap([1, 1000])
+    bits = bytes(bitmap.bits)
+    bitmap.add(-1)
+    bitmap.add(-8000)
+    assert bytes(bitmap.bits) == bits
+    assert -1 not in bitmap and -8000 not in bitmap and -7 not in bitmap
@@ -0,0 +1,37 @@
+import asyncio
+import datetime
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from stat import S_IFREG
+
+from stream_zip import ZIP_64
+
+import db
+
+
+async def member_files(zip_index, count):
+    """Member files whose contents are fetched on the default executor, like works are in a bulk download"""
+    for i in range(count):
+        async def contents(i=i):
+            yield await asyncio.to_thread(lambda: f"zip {zip_index} work {i}".encode())
+
+        yield f"{i}.txt", datetime.datetime.now(), S_IFREG | 0o600, ZIP_64, contents()
+
+
+async def make_zips(concurrent_zips):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+
+    async def make_zip(zip_index):
+        return b"".join([chunk async for chunk in
+                         db.stream_zip_in_executor(member_files(zip_index, 3), db.bulk_zip_executor)])
+
+    return await asyncio.wait_for(asyncio.gather(*[make_zip(i) for i in range(concurrent_zips)]), 10)
+
+
+def test_more_zips_than_default_executor_threads_finish():
+    zips = asyncio.run(make_zips(6))
+    for zip_index, data in enumerate(zips):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            assert [archive.read(f"{i}.txt") for i in range(3)] == [f"zip {zip_index} work {i}".encode()
+                                                                     for i in range(3)]
@@ -0,0 +1,47 @@
+import random
+
+import pytest
+import zstandard
+
+from storage_managers import compression
+
+rng = random.Random(3)
+words = [bytes(rng.choice(b"abcdefghij") for _ in range(rng.randint(2, 8))) for _ in range(300)]
+samples = [b"<p>" + b" ".join(rng.choice(words) for _ in range(50)) + b"</p>" for _ in range(500)]
+
+
+@pytest.fixture
+def dictionary(tmp_path):
+    dictionary = zstandard.train_dictionary(8 * 1024, samples)
+    (tmp_path / f"{dictionary.dict_id()}.zdict").write_bytes(dictionary.as_bytes())
+    return dictionary
+
+
+def test_writes_without_a_dictionary_unless_one_is_named(tmp_path, dictionary):
+    codec = compression.ZstdCodec(3, str(tmp_path))
+    assert zstandard.get_frame_parameters(codec.compress(samples[0])).dict_id == 0
+
+
+def test_reads_dictionaries_saved_after_starting(tmp_path):
+    codec = compression.ZstdCodec(3, str(tmp_path))
+    assert codec.decompress(codec.compress(samples[0])) == samples[0]
+
+    dictionary = zstandard.train_dictionary(8 * 1024, samples)
+    (tmp_path / f"{dictionary.dict_id()}.zdict").write_bytes(dictionary.as_bytes())
+    blob = zstandard.ZstdCompressor(dict_data=dictionary).compress(samples[1])
+    assert codec.decompress(blob) == samples[1]
+
+
+def test_writes_with_the_named_dictionary(tmp_path, dictionary):
+    codec = compression.ZstdCodec(3, str(tmp_path), dictionary.dict_id())
+    blob = codec.compress(samples[0])
+    assert zstandard.get_frame_parameters(blob).dict_id == dictionary.dict_id()
+    assert compression.ZstdCodec(3, str(tmp_path)).decompress(blob) == samples[0]
+
+
+def test_unknown_dictionaries(tmp_path, dictionary):
+    blob = zstandard.ZstdCompressor(dict_data=dictionary).compress(samples[0])
+    with pytest.raises(compression.UnknownDictionary):
+        compression.ZstdCodec(3, None).decompress(blob)
+    with pytest.raises(compression.UnknownDictionary):
+        compression.ZstdCodec(3, str(tmp_path), dictionary.dict_id() + 1)
@@ -0,0 +1,59 @@
+import random
+
+import pytest
+
+from storage_managers import chunking, delta_codecs
+
+rng = random.Random(5)
+words = [bytes(rng.choice(b"abcdefghij") for _ in range(rng.randint(2, 8))) for _ in range(500)]
+paragraphs = [b" ".join(rng.choice(words) for _ in range(80)) for _ in range(200)]
+source = b"\n".join(paragraphs)
+# An edited paragraph, an inserted one and a removed one
+edited = paragraphs[:]
+edited[20] = edited[20][:100] + b" an edit " + edited[20][100:]
+edited.insert(120, b"a new paragraph")
+del edited[150]
+target = b"\n".join(edited)
+
+
+@pytest.mark.parametrize("name", ["bsdiff", "linediff", "chunkcopy"])
+@pytest.mark.parametrize("old, new", [
+    (source, target),
+    (target, source),
+    (source, source),
+    (b"", target),
+    (source, b""),
+    (rng.randbytes(50000), rng.randbytes(40000)),  # Nothing in common
+])
+def test_patch_rebuilds_the_target(name, old, new):
+    codec = delta_codecs.delta_codecs[name]
+    assert codec.patch(old, codec.diff(old, new)) == new
+
+
+def test_linediff_deltas_only_hold_the_edited_lines():
+    assert len(delta_codecs.delta_codecs["linediff"].diff(source, target)) < 1000
+
+
+def test_chunkcopy_deltas_only_hold_the_edited_chunks():
+    # Ten copies, so the edits touch a few chunks out of many
+    delta = delta_codecs.delta_codecs["chunkcopy"].diff(source * 10, target + source * 9)
+    assert len(delta) < 8 * chunking.avg_chunk_size
+
+
+@pytest.mark.parametrize("file_format, size, expected", [
+    ("html", 1000, "bsdiff"),
+    ("pdf", delta_codecs.bsdiff_max_size, "bsdiff"),
+    ("html", delta_codecs.bsdiff_max_size + 1, "linediff"),
+    ("txt", 50 * 1024 ** 2, "linediff"),
+    ("pdf", delta_codecs.bsdiff_max_size + 1, None),
+    ("epub", 50 * 1024 ** 2, None),
+])
+def test_choose_delta_codec(file_format, size, expected):
+    codec = delta_codecs.choose_delta_codec(file_format, size)
+    assert (codec and codec.name) == expected
+
+
+def test_forced_codec_is_always_chosen(monkeypatch):
+    monkeypatch.setattr(delta_codecs, "forced_codec", "chunkcopy")
+    assert delta_codecs.choose_delta_codec("html", 1000).name == "chunkcopy"
+    assert delta_codecs.choose_delta_codec("epub", 50 * 1024 ** 2).name == "chunkcopy"
@@ -0,0 +1,78 @@
+import asyncio
+
+import notifications
+
+
+def test_failing_handlers_dont_stop_the_others():
+    listener = notifications.Listener("")
+    received = []
+
+    def failing(payload):
+        raise ValueError(payload)
+
+    listener.on("a", failing)
+    listener.on("a", received.append)
+    listener.on("b", received.append)
+    listener._dispatch_all(None)
+    assert received == [None, None]
+
+
+def test_keyed_waiters_wake_only_their_key():
+    async def run():
+        waiters = notifications.KeyedWaiters()
+        with waiters.waiter("1") as one, waiters.waiter("1") as other_one, waiters.waiter("2") as two:
+            waiters.notify("1")
+            assert one.is_set() and other_one.is_set() and not two.is_set()
+            waiters.notify(None)
+            assert two.is_set()
+        assert waiters.waiters == {}
+
+    asyncio.run(run())
+
+
+def test_keyed_waiters_are_removed_on_timeout():
+    async def run():
+        waiters = notifications.KeyedWaiters()
+        with waiters.waiter("1") as event:
+            assert not await notifications.wait_for(event, 0.01)
+        assert waiters.waiters == {}
+        waiters.notify("1")
+
+    asyncio.run(run())
+
+
+def test_fifo_waiters_wake_the_oldest_first():
+    async def run():
+        waiters = notifications.FifoWaiters()
+        with waiters.waiter() as first, waiters.waiter() as second, waiters.waiter() as third:
+            waiters.notify_one()
+            assert [first.is_set(), second.is_set(), third.is_set()] == [True, False, False]
+            waiters.notify("5")  # More than are waiting
+            assert second.is_set() and third.is_set()
+        assert len(waiters.waiters) == 0
+
+    asyncio.run(run())
+
+
+def test_fifo_waiters_registered_first_go_to_the_front():
+    async def run():
+        waiters = notifications.FifoWaiters()
+        with waiters.waiter() as waiting, waiters.waiter(first=True) as retrying:
+            waiters.notify("1")
+            assert retrying.is_set() and not waiting.is_set()
+
+    asyncio.run(run())
+
+
+def test_fifo_waiters_are_removed_on_timeout():
+    async def run():
+        waiters = notifications.FifoWaiters()
+        with waiters.waiter() as timed_out:
+            assert not await notifications.wait_for(timed_out, 0.01)
+        with waiters.waiter() as waiting:
+            # The timed out waiter doesn't use up the notification
+            waiters.notify_one()
+            assert waiting.is_set() and not timed_out.is_set()
+        assert len(waiters.waiters) == 0
+
+    asyncio.run(run())
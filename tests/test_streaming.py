@@ -0,0 +1,67 @@
+import pytest
+from starlette.requests import Request
+
+import streaming
+
+etag = '"abc"'
+
+
+def make_request(headers):
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"",
+                    "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()]})
+
+
+def parse(range_header, size=10, **headers):
+    return streaming.parse_range(make_request({"Range": range_header, **headers}), etag, size)
+
+
+def test_no_range_header():
+    assert streaming.parse_range(make_request({}), etag, 10) is None
+
+
+@pytest.mark.parametrize("range_header, expected", [
+    ("bytes=0-3", (0, 4)),
+    ("bytes=9-9", (9, 10)),
+    ("bytes=3-100", (3, 10)),  # The end is clamped to the size
+])
+def test_closed_ranges(range_header, expected):
+    assert parse(range_header) == expected
+
+
+def test_open_ended_range():
+    assert parse("bytes=5-") == (5, 10)
+
+
+@pytest.mark.parametrize("range_header, expected", [
+    ("bytes=-4", (6, 10)),
+    ("bytes=-100", (0, 10)),  # Longer than the body, so all of it
+])
+def test_suffix_ranges(range_header, expected):
+    assert parse(range_header) == expected
+
+
+@pytest.mark.parametrize("range_header", ["bytes=-0", "bytes=10-", "bytes=20-30"])
+def test_unsatisfiable_ranges(range_header):
+    with pytest.raises(streaming.RangeNotSatisfiable):
+        parse(range_header)
+
+
+@pytest.mark.parametrize("range_header", ["bytes=-4", "bytes=0-", "bytes=0-3"])
+def test_ranges_of_an_empty_body_are_unsatisfiable(range_header):
+    with pytest.raises(streaming.RangeNotSatisfiable):
+        parse(range_header, size=0)
+
+
+@pytest.mark.parametrize("range_header", [
+    "bytes=5-3",  # The end is before the start
+    "bytes=x-1",
+    "items=0-3",
+    "bytes=0-1,4-5",  # Multiple ranges get the whole body
+])
+def test_ignored_ranges(range_header):
+    assert parse(range_header) is None
+
+
+def test_if_range():
+    assert parse("bytes=0-3", **{"If-Range": etag}) == (0, 4)
+    assert parse("bytes=0-3", **{"If-Range": '"other"'}) is None
@@ -0,0 +1,174 @@
+"""
+Runs the download worker end to end against a stand-in origin and a stand-in job server, both served locally.
+"""
+import email
+import email.policy
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import worker  # noqa: E402
+
+
+class LocalServer:
+    """Serves a handler class on a free local port in a background thread"""
+    def __init__(self, handler):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Origin(http.server.BaseHTTPRequestHandler):
+    """Serves works that embed a live image, a dead image and one from a host that refuses connections"""
+    protocol_version = "HTTP/1.1"
+    requests = []
+
+    def do_GET(self):
+        Origin.requests.append((time.monotonic(), self.path, self.headers.get("If-None-Match")))
+        if self.path.startswith("/downloads/404/"):
+            self.respond(404, b"not found")
+        elif self.path.startswith("/downloads/"):
+            work_id = self.path.split("/")[2]
+            self.respond(200, (f'<html><body><p>Work {work_id}</p><img src="/images/live.png">'
+                               f'<img src="/images/dead.png"><img src="http://127.0.0.1:1/refused.png">'
+                               f'</body></html>').encode(), "text/html")
+        elif self.path == "/images/live.png":
+            if self.headers.get("If-None-Match") == '"live"':
+                self.respond(304, b"")
+            else:
+                self.respond(200, b"live image", "image/png", {"ETag": '"live"'})
+        else:
+            self.respond(404, b"not found")
+
+    def respond(self, status, body, content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class JobServer(http.server.BaseHTTPRequestHandler):
+    """Hands out the queued jobs once, and records what's submitted and failed"""
+    protocol_version = "HTTP/1.1"
+    jobs = []
+    submitted = {}
+    failed = {}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path == "/request_job":
+            request = json.loads(body)
+            jobs, JobServer.jobs[:] = JobServer.jobs[:request["max_jobs"]], JobServer.jobs[request["max_jobs"]:]
+            self.respond({"status": "jobs assigned" if jobs else "queue empty", "jobs": jobs})
+        elif self.path == "/submit_job":
+            form = email.message_from_bytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body,
+                                            policy=email.policy.HTTP)
+            fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                      for part in form.iter_parts()}
+            JobServer.submitted[int(fields["dispatch_id"])] = fields
+            self.respond({"status": "successfully submitted"})
+        elif self.path == "/job_fail":
+            failure = json.loads(body)
+            JobServer.failed[failure["dispatch_id"]] = failure["fail_status"]
+            self.respond({"status": "successfully failed!"})
+
+    def respond(self, result):
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_job(dispatch_id, work_id, cache_infos=None):
+    return {"dispatch_id": dispatch_id, "job_id": dispatch_id, "work_id": work_id, "work_format": "html",
+            "report_code": 1000 + dispatch_id, "updated": 1, "get_img": True, "cache_infos": cache_infos or {}}
+
+
+@pytest.fixture
+def servers():
+    Origin.requests = []
+    JobServer.jobs, JobServer.submitted, JobServer.failed = [], {}, {}
+    origin, job_server = LocalServer(Origin), LocalServer(JobServer)
+    yield origin, job_server
+    origin.close()
+    job_server.close()
+
+
+def run_worker(origin, job_server, rate_limit=100):
+    download_worker = worker.Worker(job_server.url, "token", "test", origin.url, concurrency=4,
+                                    rate_limit=rate_limit, job_wait=0)
+    leased = download_worker.run_once()
+    download_worker.fetchers.shutdown(wait=True)
+    download_worker.submitters.shutdown(wait=True)
+    return leased
+
+
+def test_submits_work_without_the_images_that_failed(servers):
+    origin, job_server = servers
+    JobServer.jobs = [make_job(1, 100)]
+    assert run_worker(origin, job_server) == 1
+
+    assert JobServer.failed == {}
+    submission = JobServer.submitted[1]
+    assert submission["report_code"] == b"1001"
+    assert b"<p>Work 100</p>" in submission["work"]
+    assert submission["supporting_objects_0_url"] == b"/images/live.png"
+    assert submission["supporting_objects_0_etag"] == b'"live"'
+    assert submission["supporting_objects_0"] == b"live image"
+    assert "supporting_objects_1_url" not in submission and "cached_1_url" not in submission
+
+
+def test_sends_cached_references_for_unchanged_images(servers):
+    origin, job_server = servers
+    cache_info = {"etag": '"live"', "sha1": "0" * 40, "object_id": 7, "url": "/images/live.png",
+                  "time": "2024-01-01T00:00:00"}
+    JobServer.jobs = [make_job(1, 100, {"/images/live.png": cache_info})]
+    run_worker(origin, job_server)
+
+    submission = JobServer.submitted[1]
+    assert submission["cached_0_url"] == b"/images/live.png"
+    assert submission["cached_0_object_id"] == b"7"
+    assert "supporting_objects_0" not in submission
+    assert ("/images/live.png", '"live"') in [(path, etag) for _, path, etag in Origin.requests]
+
+
+def test_fails_jobs_for_missing_works(servers):
+    origin, job_server = servers
+    JobServer.jobs = [make_job(1, 404), make_job(2, 101)]
+    assert run_worker(origin, job_server) == 2
+
+    assert JobServer.failed == {1: 404}
+    assert list(JobServer.submitted) == [2]
+
+
+def test_rate_limits_requests_to_the_origin(servers):
+    origin, job_server = servers
+    JobServer.jobs = [make_job(1, 100), make_job(2, 101)]
+    run_worker(origin, job_server, rate_limit=10)
+
+    # Two works and two images each, as the refused host is a different host
+    times = sorted(request_time for request_time, _, _ in Origin.requests)
+    assert len(times) == 6
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
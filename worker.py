@@ -1,11 +1,225 @@
+"""
+Download worker. Leases jobs from the server, fetches each work (and the images of html works) from the origin and
+submits them back. Several jobs are fetched at once, with requests to each host spaced out by the rate limit, and
+submissions are sent in the background so the next fetch doesn't wait on them.
+
+Configured by environment variables:
+    SERVER_URL            the ao3_saver_backend server, default http://127.0.0.1:8000
+    ADMIN_TOKEN           token for the job endpoints
+    WORKER_NAME           client name reported to the server, default the hostname
+    ORIGIN_URL            where works are downloaded from, default https://archiveofourown.org
+    WORKER_CONCURRENCY    jobs fetched at once, default 4
+    ORIGIN_RATE_LIMIT     requests per second to each host, default 1
+    JOB_WAIT              seconds to long-poll /request_job for when the queue is empty, default 30
+
+For testing, point ORIGIN_URL at a local server serving /downloads/<work_id>/<name>.<format>.
+"""
+import hashlib
+import os
+import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+
+class HostRateLimiter:
+    """Spaces out requests to each host so none gets more than per_second requests a second"""
+    def __init__(self, per_second: float):
+        self.interval = 1 / per_second if per_second > 0 else 0
+        self.next_slot: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def back_off(self, url: str, seconds: float) -> None:
+        """Holds off every request to the url's host for seconds, ex: after being told to slow down"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            self.next_slot[host] = max(self.next_slot.get(host, 0), time.monotonic() + seconds)
+
+
+class FetchFailed(Exception):
+    def __init__(self, url: str, status: int):
+        super().__init__(f"fetching {url} failed with status {status}")
+        self.url = url
+        self.status = status
+
+    @property
+    def permanent(self) -> bool:
+        """Whether retrying won't help, ex: the work was deleted. Other failures are left for the lease to expire."""
+        return 400 <= self.status < 500 and self.status not in (408, 429)
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """A session keeping up to pool_size connections open to each host, so they're reused between requests"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class Worker:
+    def __init__(self, server_url: str, token: str, name: str, origin_url: str, concurrency: int,
+                 rate_limit: float, job_wait: float):
+        self.server_url = server_url.rstrip("/")
+        self.origin_url = origin_url.rstrip("/")
+        self.name = name
+        self.concurrency = concurrency
+        self.job_wait = job_wait
+        self.limiter = HostRateLimiter(rate_limit)
+        self.server = pooled_session(concurrency)
+        self.server.headers["token"] = token
+        self.origin = pooled_session(concurrency)
+        self.fetchers = ThreadPoolExecutor(concurrency, thread_name_prefix="fetch")
+        self.submitters = ThreadPoolExecutor(2, thread_name_prefix="submit")
+        # Free fetch slots. Jobs are only leased when one is free, so a leased job never waits for a slot.
+        self.slots = threading.Semaphore(concurrency)
+
+    @classmethod
+    def from_env(cls) -> "Worker":
+        return cls(os.environ.get("SERVER_URL", "http://127.0.0.1:8000"), os.environ.get("ADMIN_TOKEN", ""),
+                   os.environ.get("WORKER_NAME", socket.gethostname()),
+                   os.environ.get("ORIGIN_URL", "https://archiveofourown.org"),
+                   int(os.environ.get("WORKER_CONCURRENCY", 4)), float(os.environ.get("ORIGIN_RATE_LIMIT", 1)),
+                   float(os.environ.get("JOB_WAIT", 30)))
+
+    def run(self) -> None:
+        while True:
+            self.run_once()
+
+    def run_once(self) -> int:
+        """Waits for a free slot, then leases a job for every free slot and starts fetching them"""
+        self.slots.acquire()
+        free = 1
+        while free < self.concurrency and self.slots.acquire(blocking=False):
+            free += 1
+        try:
+            jobs = self.request_jobs(free)
+        except requests.RequestException as e:
+            print(f"Requesting jobs failed: {e}")
+            jobs = []
+            time.sleep(5)
+        for _ in range(free - len(jobs)):
+            self.slots.release()
+        for job in jobs:
+            self.fetchers.submit(self.process, job)
+        return len(jobs)
+
+    def request_jobs(self, count: int) -> List[dict]:
+        response = self.server.post(f"{self.server_url}/request_job", timeout=self.job_wait + 30,
+                                    json={"client_name": self.name, "max_jobs": count, "wait": self.job_wait})
+        response.raise_for_status()
+        result = response.json()
+        # A single job comes back on its own rather than in a list
+        if "jobs" in result:
+            return result["jobs"]
+        return [result] if result["status"] == "job assigned" else []
+
+    def process(self, job: dict) -> None:
+        try:
+            work, objects = self.fetch(job)
+        except FetchFailed as e:
+            print(f"Job {job['job_id']} (work {job['work_id']}): {e}")
+            if e.permanent:
+                self.submitters.submit(self.fail, job, e.status)
+        except Exception as e:
+            print(f"Job {job['job_id']} (work {job['work_id']}) failed: {e!r}")
+        else:
+            self.submitters.submit(self.submit, job, work, objects)
+        finally:
+            self.slots.release()
+
+    def get(self, url: str, headers: Dict[str, str] | None = None) -> requests.Response:
+        self.limiter.wait(url)
+        try:
+            response = self.origin.get(url, headers=headers, timeout=60)
+        except requests.RequestException:
+            raise FetchFailed(url, 0)
+        if response.status_code == 429:
+            self.limiter.back_off(url, float(response.headers.get("Retry-After", 60)))
+        if response.status_code >= 400:
+            raise FetchFailed(url, response.status_code)
+        return response
+
+    def fetch(self, job: dict) -> tuple[bytes, List[tuple]]:
+        """Fetches a job's work and its images, returning the work and the objects to submit with it"""
+        work_url = (f"{self.origin_url}/downloads/{job['work_id']}/work.{job['work_format']}"
+                    f"?updated_at={job['updated']}")
+        work = self.get(work_url).content
+        if job["work_format"] != "html" or not job["get_img"]:
+            return work, []
+
+        sources = []
+        for img in BeautifulSoup(work, "html.parser").find_all("img", src=True):
+            if not img["src"].startswith("data:") and img["src"] not in sources:
+                sources.append(img["src"])
+        objects = []
+        for src in sources:
+            try:
+                objects.append(self.fetch_object(urljoin(work_url, src), src, job["cache_infos"].get(src)))
+            except FetchFailed as e:
+                # Dead hotlinked images are common, and the work is still worth archiving without them
+                print(f"Job {job['job_id']} (work {job['work_id']}): skipping image, {e}")
+        return work, objects
+
+    def fetch_object(self, url: str, src: str, cache_info: dict | None) -> tuple:
+        """
+        Fetches an image, returning ("cached", src, object_id) when the server already has it, either because the
+        origin says the etag still matches or because the download hashes the same, or else
+        ("file", src, etag, mimetype, data).
+        """
+        headers = {}
+        if cache_info is not None and cache_info["etag"]:
+            headers["If-None-Match"] = cache_info["etag"]
+        response = self.get(url, headers)
+        if cache_info is not None and (response.status_code == 304 or
+                                       hashlib.sha1(response.content).hexdigest() == cache_info["sha1"]):
+            return "cached", src, cache_info["object_id"]
+        return ("file", src, response.headers.get("ETag", ""),
+                response.headers.get("Content-Type", "application/octet-stream"), response.content)
 
+    def submit(self, job: dict, work: bytes, objects: List[tuple]) -> None:
+        data = {"dispatch_id": job["dispatch_id"], "report_code": job["report_code"]}
+        files = {"work": (f"{job['work_id']}.{job['work_format']}", work)}
+        for i, obj in enumerate(objects):
+            if obj[0] == "cached":
+                data[f"cached_{i}_url"] = obj[1]
+                data[f"cached_{i}_object_id"] = obj[2]
+            else:
+                _, src, etag, mimetype, content = obj
+                data[f"supporting_objects_{i}_url"] = src
+                data[f"supporting_objects_{i}_etag"] = etag
+                files[f"supporting_objects_{i}"] = (os.path.basename(urlsplit(src).path) or "object", content,
+                                                    mimetype)
+        try:
+            response = self.server.post(f"{self.server_url}/submit_job", data=data, files=files, timeout=300)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Submitting job {job['job_id']} (work {job['work_id']}) failed: {e}")
 
-def do_loop():
-    while True:
-        time.sleep(10)
-        get_job()
+    def fail(self, job: dict, status: int) -> None:
+        try:
+            response = self.server.post(f"{self.server_url}/job_fail", timeout=60,
+                                        json={"dispatch_id": job["dispatch_id"], "fail_status": status,
+                                              "report_code": job["report_code"]})
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"Reporting job {job['job_id']} (work {job['work_id']}) as failed failed: {e}")
 
 
-def get_job():
-    pass
+if __name__ == "__main__":
+    Worker.from_env().run()